@@ -0,0 +1,510 @@
+"""Stand-ins for EC2 and the benchmarked instances, for measuring the
+orchestration (see orchestration.py) without launching anything.
+
+FakeCloud keeps the state of the fake instances and counts the API calls.
+Its clients implement the EC2, Service Quotas and Secrets Manager calls
+aws_helpers makes, with injectable errors, and it runs an in-process
+paramiko SSH server which plays all the instances: each one gets its own
+loopback address (127.1.x.y), its commands (docker pulls, the init script,
+the agent and tail) are answered after configurable latencies. The agent is
+the real cloudperf.agent, with the docker commands faked.
+"""
+import io
+import re
+import json
+import time
+import random
+import socket
+import threading
+import traceback
+import collections
+import paramiko
+from botocore.exceptions import ClientError
+from cloudperf import agent
+
+# the instance whose agent runs in the current thread
+_local = threading.local()
+
+
+def client_error(code, message, operation):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class FakeInstance(object):
+    def __init__(self, cloud, instance_id, ip, instance_type, spot):
+        self.cloud = cloud
+        self.id = instance_id
+        self.ip = ip
+        self.instance_type = instance_type
+        self.spot = spot
+        self.launched = time.time()
+        self.running_at = self.launched + cloud.boot_time
+        self.terminated = None
+        self.files = {}
+        self.results = []
+        self.agent_done = False
+        self.cond = threading.Condition()
+        # phase name -> first time it happened
+        self.events = {'launched': self.launched}
+        # the simulated (sleeping) time of the agent's commands
+        self.busy = 0.0
+
+    def state(self, now=None):
+        if self.terminated is not None:
+            return 'terminated'
+        return 'running' if (now or time.time()) >= self.running_at else 'pending'
+
+    def event(self, name):
+        with self.cond:
+            self.events.setdefault(name, time.time())
+
+    def describe(self):
+        return {'InstanceId': self.id, 'InstanceType': self.instance_type, 'PrivateIpAddress': self.ip,
+                'State': {'Name': self.state()},
+                'Tags': [{'Key': 'Application', 'Value': 'cloudperf'}]}
+
+    def emit(self, line):
+        with self.cond:
+            self.results.append(line)
+            self.cond.notify_all()
+
+    def run_agent(self):
+        """Run the real agent's benchmarks with the faked commands, like
+        agent.main does"""
+        _local.instance = self
+        self.event('agent_start')
+        results = InstanceResults(self)
+        try:
+            plan = json.loads(self.files['plan.json'])
+            for bench in plan['benchmarks']:
+                try:
+                    agent.run_benchmark(bench, results)
+                    results.emit('complete', benchmark_id=bench['id'])
+                except Exception:
+                    results.emit('error', benchmark_id=bench['id'], error=traceback.format_exc())
+        finally:
+            results.emit('done')
+            self.event('agent_done')
+            with self.cond:
+                self.agent_done = True
+                self.cond.notify_all()
+
+
+class InstanceResults(object):
+    """agent.Results, writing into the instance's memory"""
+
+    def __init__(self, instance):
+        self.instance = instance
+
+    def emit(self, type, **record):
+        record.update({'type': type, 'time': time.time()})
+        self.instance.emit(json.dumps(record))
+
+
+def fake_run(cmd):
+    """agent.run: sleep for the command's latency and give a plausible output"""
+    instance = _local.instance
+    cloud = instance.cloud
+    if 'docker run' in cmd:
+        latency = cloud.run_time
+        output = '{:.3f}'.format(100 * cloud.uniform(0.98, 1.02))
+    elif cmd == 'sync':
+        latency, output = 0, ''
+    else:
+        # docker-compose and the after_compose scripts
+        latency, output = cloud.run_time, ''
+    time.sleep(latency)
+    instance.busy += latency
+    return 0, output, ''
+
+
+def fake_write_file(name, contents, mode=0o755):
+    _local.instance.files[name] = contents
+
+
+def fake_log(msg):
+    files = _local.instance.files
+    files['agent.log'] = files.get('agent.log', '') + '{} {}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), msg)
+
+
+class FakePaginator(object):
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            if token:
+                kwargs['NextToken'] = token
+            page = self.method(**kwargs)
+            yield page
+            token = page.get('NextToken')
+            if not token:
+                return
+
+
+class FakeEC2(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def run_instances(self, **specs):
+        cloud = self.cloud
+        cloud.call('ec2.RunInstances')
+        instance_type = specs['InstanceType']
+        spot = 'InstanceMarketOptions' in specs
+        with cloud.lock:
+            cloud.first_request.setdefault(instance_type, time.time())
+        if cloud.inject('RequestLimitExceeded'):
+            raise client_error('RequestLimitExceeded', 'Request limit exceeded.', 'RunInstances')
+        if cloud.inject('InsufficientInstanceCapacity'):
+            raise client_error('InsufficientInstanceCapacity',
+                               'We currently do not have sufficient {} capacity.'.format(instance_type),
+                               'RunInstances')
+        if spot and cloud.inject('SpotMaxPriceTooLow'):
+            max_price = float(specs['InstanceMarketOptions']['SpotOptions']['MaxPrice'])
+            raise client_error('SpotMaxPriceTooLow',
+                               'Your Spot request price of {:.4f} is lower than the minimum required Spot '
+                               'request fulfillment price of {:.4f}.'.format(max_price, max_price*1.5),
+                               'RunInstances')
+        instance = cloud.launch(instance_type, spot)
+        return {'Instances': [instance.describe()]}
+
+    def describe_instances(self, InstanceIds=None, Filters=None, MaxResults=None, NextToken=None):
+        cloud = self.cloud
+        cloud.call('ec2.DescribeInstances')
+        if cloud.inject('RequestLimitExceeded'):
+            raise client_error('RequestLimitExceeded', 'Request limit exceeded.', 'DescribeInstances')
+        with cloud.lock:
+            instances = list(cloud.instances.values())
+        ids = set(InstanceIds or [])
+        for f in Filters or []:
+            if f['Name'] == 'instance-id':
+                ids |= set(f['Values'])
+            elif f['Name'] == 'instance-state-name':
+                instances = [i for i in instances if i.state() in f['Values']]
+        if InstanceIds is not None or ids:
+            instances = [i for i in instances if i.id in ids]
+        start = int(NextToken or 0)
+        end = len(instances) if MaxResults is None else start + MaxResults
+        for instance in instances[start:end]:
+            if instance.state() == 'running':
+                instance.event('running_seen')
+        page = {'Reservations': [{'Instances': [i.describe() for i in instances[start:end]]}]}
+        if end < len(instances):
+            page['NextToken'] = str(end)
+        return page
+
+    def terminate_instances(self, InstanceIds):
+        self.cloud.call('ec2.TerminateInstances')
+        for instance_id in InstanceIds:
+            instance = self.cloud.instances[instance_id]
+            instance.event('terminated')
+            instance.terminated = time.time()
+        return {'TerminatingInstances': [{'InstanceId': i} for i in InstanceIds]}
+
+    def describe_images(self, **kwargs):
+        self.cloud.call('ec2.DescribeImages')
+        return {'Images': [{'ImageId': 'ami-00000000', 'CreationDate': '2020-01-01T00:00:00.000Z',
+                            'BlockDeviceMappings': [{'DeviceName': '/dev/xvda',
+                                                     'Ebs': {'Encrypted': False, 'VolumeSize': 30}}]}]}
+
+    def describe_regions(self, **kwargs):
+        self.cloud.call('ec2.DescribeRegions')
+        return {'Regions': [{'RegionName': 'us-east-1'}]}
+
+    def get_paginator(self, name):
+        return FakePaginator(getattr(self, name))
+
+
+class FakeServiceQuotas(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def get_service_quota(self, ServiceCode, QuotaCode):
+        self.cloud.call('service-quotas.GetServiceQuota')
+        return {'Quota': {'Value': float(self.cloud.vcpu_quota)}}
+
+
+class FakeSecretsManager(object):
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def get_secret_value(self, SecretId):
+        self.cloud.call('secretsmanager.GetSecretValue')
+        f = io.StringIO()
+        self.cloud.client_key.write_private_key(f)
+        return {'SecretString': f.getvalue()}
+
+
+class FakeSFTP(paramiko.SFTPServerInterface):
+    """Keeps the written files in the instance's memory"""
+
+    def __init__(self, server, *args, **kwargs):
+        super(FakeSFTP, self).__init__(server, *args, **kwargs)
+        self.instance = server.instance
+
+    def open(self, path, flags, attr):
+        return FakeSFTPHandle(self.instance, path, flags)
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK if path in self.instance.files else paramiko.SFTP_NO_SUCH_FILE
+
+    def stat(self, path):
+        if path not in self.instance.files:
+            return paramiko.SFTP_NO_SUCH_FILE
+        attr = paramiko.SFTPAttributes()
+        attr.st_size = len(self.instance.files[path])
+        attr.st_mode = 0o100644
+        return attr
+
+    lstat = stat
+
+
+class FakeSFTPHandle(paramiko.SFTPHandle):
+    def __init__(self, instance, path, flags):
+        super(FakeSFTPHandle, self).__init__(flags)
+        self.instance = instance
+        self.path = path
+        self.buffer = io.BytesIO()
+
+    def write(self, offset, data):
+        self.buffer.seek(offset)
+        self.buffer.write(data)
+        return paramiko.SFTP_OK
+
+    def close(self):
+        self.instance.files[self.path] = self.buffer.getvalue().decode('utf-8')
+        super(FakeSFTPHandle, self).close()
+
+
+class FakeTransport(paramiko.Transport):
+    """Starts the exec handlers only after their requests have been
+    acknowledged, as closing the channel before that fails the request"""
+
+    def __init__(self, sock):
+        super(FakeTransport, self).__init__(sock)
+        self.pending = []
+
+    def _send_user_message(self, data):
+        super(FakeTransport, self)._send_user_message(data)
+        # the transport thread replies to the requests
+        if threading.current_thread() is self:
+            pending, self.pending = self.pending, []
+            for t in pending:
+                t.start()
+
+
+class FakeSSHServer(paramiko.ServerInterface):
+    """One connection to an instance, answering its exec requests"""
+
+    commands = [
+        (re.compile(r'docker pull (\S+) && sync && sleep \d+$'), 'pull'),
+        (re.compile(r'\./init_script$'), 'init'),
+        (re.compile(r'rm -f results\.jsonl; nohup .* agent\.py plan\.json results\.jsonl .*& echo \$!$'), 'start'),
+        (re.compile(r'tail --pid=\d+ -n \+(\d+) -F results\.jsonl'), 'tail'),
+        (re.compile(r'tail -\d+ agent\.log$'), 'log'),
+    ]
+
+    def __init__(self, cloud, instance, transport):
+        self.cloud = cloud
+        self.instance = instance
+        self.transport = transport
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        if key.get_base64() != self.cloud.client_key.get_base64():
+            return paramiko.AUTH_FAILED
+        self.instance.event('ssh_connected')
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        command = command.decode('utf-8')
+        self.cloud.call('ssh.Exec')
+        t = threading.Thread(target=self.exec_command, args=(channel, command), name='fake-exec')
+        t.daemon = True
+        self.transport.pending.append(t)
+        return True
+
+    def exec_command(self, channel, command):
+        try:
+            for regex, kind in self.commands:
+                m = regex.match(command)
+                if m:
+                    code = getattr(self, 'cmd_' + kind)(channel, *m.groups())
+                    break
+            else:
+                channel.sendall_stderr('fake: unknown command: {}\n'.format(command).encode('utf-8'))
+                code = 127
+            channel.send_exit_status(code)
+        except (EOFError, socket.error, paramiko.SSHException):
+            # the connection was dropped
+            return
+        finally:
+            channel.close()
+
+    def cmd_pull(self, channel, image):
+        self.instance.event('pull_start')
+        time.sleep(self.cloud.pull_time)
+        if self.cloud.inject('PullFailure'):
+            channel.sendall_stderr(b'Error response from daemon: net/http: TLS handshake timeout\n')
+            return 1
+        return 0
+
+    def cmd_init(self, channel):
+        self.instance.event('init_start')
+        time.sleep(self.cloud.init_time)
+        return 0
+
+    def cmd_start(self, channel):
+        instance = self.instance
+        with instance.cond:
+            instance.results = []
+            instance.agent_done = False
+        t = threading.Thread(target=instance.run_agent, name='fake-agent-{}'.format(instance.id))
+        t.daemon = True
+        t.start()
+        channel.sendall('{}\n'.format(t.ident % 32768).encode('utf-8'))
+        return 0
+
+    def cmd_tail(self, channel, start):
+        instance = self.instance
+        seen = int(start) - 1
+        while True:
+            with instance.cond:
+                while seen >= len(instance.results) and not instance.agent_done:
+                    instance.cond.wait(1)
+                lines = instance.results[seen:]
+                done = instance.agent_done
+            for line in lines:
+                if self.cloud.inject('Disconnect'):
+                    self.transport.close()
+                    return 255
+                channel.sendall((line + '\n').encode('utf-8'))
+                seen += 1
+            if done and seen >= len(instance.results):
+                instance.event('results_read')
+                return 0
+
+    def cmd_log(self, channel):
+        lines = self.instance.files.get('agent.log', '').splitlines(True)
+        channel.sendall(''.join(lines[-20:]).encode('utf-8'))
+        return 0
+
+
+class FakeCloud(object):
+    """The fake EC2 and its instances.
+
+    The latencies are in seconds. error_rates gives the probability of
+    injecting each error: RequestLimitExceeded (any EC2 call),
+    InsufficientInstanceCapacity and SpotMaxPriceTooLow (run_instances, the
+    latter only for spot requests), PullFailure (docker pull) and Disconnect
+    (dropping the ssh connection before each streamed result)."""
+
+    def __init__(self, boot_time=1.0, pull_time=0.2, init_time=0.1, run_time=0.01, api_time=0.005,
+                 poll_interval=0.2, error_rates=None, vcpu_quota=100000, seed=0):
+        self.boot_time = boot_time
+        self.pull_time = pull_time
+        self.init_time = init_time
+        self.run_time = run_time
+        self.api_time = api_time
+        self.poll_interval = poll_interval
+        self.error_rates = dict(error_rates or {})
+        self.vcpu_quota = vcpu_quota
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.injected = collections.Counter()
+        self.instances = {}
+        self.by_ip = {}
+        # instance type -> time of its first run_instances request
+        self.first_request = {}
+        self.client_key = paramiko.RSAKey.generate(2048)
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = None
+
+    def call(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+        if operation.startswith(('ec2.', 'service-quotas.', 'secretsmanager.')):
+            time.sleep(self.api_time)
+
+    def uniform(self, a, b):
+        with self.lock:
+            return self.random.uniform(a, b)
+
+    def inject(self, error):
+        rate = self.error_rates.get(error, 0)
+        with self.lock:
+            if rate and self.random.random() < rate:
+                self.injected[error] += 1
+                return True
+        return False
+
+    def launch(self, instance_type, spot):
+        with self.lock:
+            n = len(self.instances) + 1
+            ip = '127.1.{}.{}'.format(n // 250, n % 250 + 1)
+            instance = FakeInstance(self, 'i-{:017x}'.format(n), ip, instance_type, spot)
+            self.instances[instance.id] = instance
+            self.by_ip[ip] = instance
+        return instance
+
+    def client(self, service, region_name=None):
+        clients = {'ec2': FakeEC2, 'service-quotas': FakeServiceQuotas, 'secretsmanager': FakeSecretsManager}
+        return clients[service](self)
+
+    def start_ssh(self):
+        """Start the ssh server, return its port"""
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # all of 127/8 is local, the instances are told apart by the address
+        # they were connected to
+        self.sock.bind(('0.0.0.0', 0))
+        self.sock.listen(128)
+        t = threading.Thread(target=self.accept_loop, name='fake-sshd')
+        t.daemon = True
+        t.start()
+        return self.sock.getsockname()[1]
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            instance = self.by_ip.get(conn.getsockname()[0])
+            if instance is None or not addr[0].startswith('127.') or instance.state() != 'running':
+                # like an instance which isn't up yet
+                conn.close()
+                continue
+            self.call('ssh.Connect')
+            transport = FakeTransport(conn)
+            transport.add_server_key(self.host_key)
+            server = FakeSSHServer(self, instance, transport)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, FakeSFTP)
+            # the channels are served by the exec threads and the sftp
+            # subsystem. They're never accept()ed, as a dropped Channel
+            # object closes itself
+            transport.start_server(server=server)
+
+    def stop(self):
+        if self.sock is not None:
+            self.sock.close()
+
+    def install(self):
+        """Point aws_helpers and the agent to the fakes"""
+        from cloudperf.providers import aws_helpers
+        aws_helpers.session = self
+        aws_helpers.aws_client = lambda service, region: self.client(service, region)
+        aws_helpers.ssh_port = self.start_ssh()
+        aws_helpers.instance_poll_interval = self.poll_interval
+        agent.run = fake_run
+        agent.write_file = fake_write_file
+        agent.log = fake_log
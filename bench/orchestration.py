@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""Measure the throughput of the benchmark orchestration offline.
+
+Runs get_ec2_performance (the scheduler, run_benchmarks, the agent and the
+result streaming) against the stand-in EC2 and ssh server of fakes.py, with
+compressed latencies and optionally injected errors, and reports the
+benchmarked instances per hour, the API calls per instance and the wall
+clock time spent in each phase of an instance's life, with the part not
+explained by the simulated latencies as overhead. The fixed waits
+(instance_settle_time, ssh_connect_delay) are set to 0, so the overhead is
+the orchestration's own, except for the connect phase, which includes the
+in-process ssh server's side of the key exchange.
+
+    python bench/orchestration.py
+    python bench/orchestration.py --instances 64 --max-running 16 --request-limit-rate 0.2 --json out.json
+"""
+import os
+import sys
+import copy
+import json
+import time
+import logging
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import pandas as pd  # noqa: E402
+from fakes import FakeCloud  # noqa: E402
+from cloudperf.providers import aws_helpers  # noqa: E402
+
+# instance families (and their CPU architecture) and sizes (and their vCPUs)
+# of the generated catalog
+families = [('c5', 'x86_64'), ('m5', 'x86_64'), ('r5', 'x86_64'), ('c6g', 'arm64'), ('m6g', 'arm64')]
+sizes = [('large', 2), ('xlarge', 4), ('2xlarge', 8), ('4xlarge', 16)]
+# (phase, start event, end event) of an instance's life
+phases = [
+    ('request', 'requested', 'launched'),
+    ('boot', 'launched', 'running_seen'),
+    ('connect', 'running_seen', 'ssh_connected'),
+    ('setup', 'ssh_connected', 'agent_start'),
+    ('benchmark', 'agent_start', 'agent_done'),
+    ('collect', 'agent_done', 'results_read'),
+    ('teardown', 'results_read', 'terminated'),
+]
+
+
+def catalog(n):
+    """An on-demand price list of n instance types"""
+    rows = []
+    for i in range(n):
+        (family, arch), (size, vcpu) = families[i % len(families)], sizes[(i // len(families)) % len(sizes)]
+        generation = i // (len(families) * len(sizes))
+        name = '{}{}.{}'.format(family, 'x' * generation, size) if generation else '{}.{}'.format(family, size)
+        rows.append({'instanceType': name, 'cpu_arch': arch, 'vcpu': vcpu, 'price': 0.05 * vcpu, 'spot': False,
+                     'region': 'us-east-1'})
+    return pd.DataFrame(rows)
+
+
+def benchmark_set(n):
+    """n copies of the first benchmark, with different ids"""
+    name, bench = next(iter(aws_helpers.benchmarks.items()))
+    return {name if i == 0 else '{}#{}'.format(name, i+1): copy.deepcopy(bench) for i in range(n)}
+
+
+def simulated(cloud, instance, phase):
+    """The latency the fakes spent in phase, the rest is overhead"""
+    if phase == 'boot':
+        return cloud.boot_time
+    if phase == 'setup':
+        return max(cloud.init_time, cloud.pull_time)
+    if phase == 'benchmark':
+        return instance.busy
+    return 0.0
+
+
+def report(cloud, wall, results):
+    instances = list(cloud.instances.values())
+    finished = [i for i in instances if 'results_read' in i.events]
+    out = {
+        'wall_seconds': wall,
+        'instance_types': len(cloud.first_request),
+        'instances_launched': len(instances),
+        'instances_benchmarked': len(finished),
+        'instances_per_hour': len(finished) / wall * 3600 if wall else 0,
+        'result_rows': len(results),
+        'injected_errors': dict(cloud.injected),
+        'calls_per_instance': {op: n / max(len(instances), 1) for op, n in sorted(cloud.calls.items())},
+        'phases': {},
+    }
+    for instance in instances:
+        instance.events.setdefault('requested', cloud.first_request.get(instance.instance_type))
+    for phase, start, end in phases:
+        durations = [(i.events[end] - i.events[start], simulated(cloud, i, phase)) for i in instances
+                     if i.events.get(start) is not None and i.events.get(end) is not None]
+        if not durations:
+            continue
+        wall_times = [d for d, _ in durations]
+        overheads = [d - s for d, s in durations]
+        out['phases'][phase] = {'n': len(durations), 'mean': statistics.mean(wall_times),
+                                'median': statistics.median(wall_times), 'max': max(wall_times),
+                                'overhead_mean': statistics.mean(overheads), 'overhead_max': max(overheads)}
+    return out
+
+
+def print_report(out):
+    print('{instances_benchmarked}/{instance_types} instance types benchmarked in {wall_seconds:.1f}s '
+          '({instances_launched} launched, {result_rows} result rows): {instances_per_hour:.0f} instances/hour'
+          .format(**out))
+    if out['injected_errors']:
+        print('Injected errors: {}'.format(', '.join('{} {}'.format(k, v)
+                                                      for k, v in sorted(out['injected_errors'].items()))))
+    print('\nCalls per instance:')
+    for op, n in out['calls_per_instance'].items():
+        print('{:>8.2f}  {}'.format(n, op))
+    print('\n{:<10} {:>5} {:>8} {:>8} {:>8} {:>10} {:>10}'.format('phase', 'n', 'mean', 'median', 'max',
+                                                                  'overhead', 'ovh max'))
+    for phase, s in out['phases'].items():
+        print('{:<10} {:>5} {:>8.3f} {:>8.3f} {:>8.3f} {:>10.3f} {:>10.3f}'.format(
+            phase, s['n'], s['mean'], s['median'], s['max'], s['overhead_mean'], s['overhead_max']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--instances', type=int, default=20, help='Number of instance types to benchmark')
+    parser.add_argument('--benchmarks', type=int, default=1, help='Number of benchmarks per instance')
+    parser.add_argument('--max-running', type=int, default=aws_helpers.max_running_instances)
+    parser.add_argument('--boot-time', type=float, default=1.0)
+    parser.add_argument('--pull-time', type=float, default=0.2)
+    parser.add_argument('--init-time', type=float, default=0.1)
+    parser.add_argument('--run-time', type=float, default=0.01, help='Latency of a docker run')
+    parser.add_argument('--api-time', type=float, default=0.005, help='Latency of an API call')
+    parser.add_argument('--poll-interval', type=float, default=0.2, help='Instance state polling interval')
+    parser.add_argument('--request-limit-rate', type=float, default=0.0)
+    parser.add_argument('--capacity-rate', type=float, default=0.0)
+    parser.add_argument('--spot-price-rate', type=float, default=0.0)
+    parser.add_argument('--pull-failure-rate', type=float, default=0.0)
+    parser.add_argument('--disconnect-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Write the report to this file as well')
+    parser.add_argument('--verbose', action='store_true', help='Show the orchestration logs')
+    opts = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if opts.verbose else logging.WARNING,
+                        format='%(asctime)s %(threadName)s %(message)s')
+    # paramiko logs every dropped connection
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    cloud = FakeCloud(boot_time=opts.boot_time, pull_time=opts.pull_time, init_time=opts.init_time,
+                      run_time=opts.run_time, api_time=opts.api_time, poll_interval=opts.poll_interval,
+                      error_rates={'RequestLimitExceeded': opts.request_limit_rate,
+                                   'InsufficientInstanceCapacity': opts.capacity_rate,
+                                   'SpotMaxPriceTooLow': opts.spot_price_rate,
+                                   'PullFailure': opts.pull_failure_rate,
+                                   'Disconnect': opts.disconnect_rate},
+                      seed=opts.seed)
+    cloud.install()
+    aws_helpers.benchmarks = benchmark_set(opts.benchmarks)
+    aws_helpers.max_running_instances = opts.max_running
+    aws_helpers.instance_settle_time = 0
+    aws_helpers.ssh_connect_delay = 0
+
+    start = time.time()
+    results = aws_helpers.get_ec2_performance(catalog(opts.instances))
+    wall = time.time() - start
+    cloud.stop()
+
+    out = report(cloud, wall, results)
+    print_report(out)
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(out, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
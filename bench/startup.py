@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Measure the CLI's startup time and the modules it imports.
+
+Runs `python -X importtime` on the given entry point (by default importing
+cloudperf.cli and running `cloudperf --help`) a few times, prints the wall
+clock time and the slowest imports, and fails if any of the modules which
+read-only commands shouldn't need (boto3, botocore, paramiko) got imported.
+
+    python bench/startup.py
+    python bench/startup.py --args 'prices --offline --help' --top 20
+"""
+import os
+import sys
+import time
+import shlex
+import argparse
+import statistics
+import subprocess
+
+# these are only needed for launching instances and writing data
+forbidden = ('boto3', 'botocore', 'paramiko')
+
+
+def run(args):
+    """Run the CLI with args, return the wall clock time and the import
+    times (module -> cumulative microseconds)"""
+    code = 'import sys; sys.argv = ["cloudperf"] + {!r}\nfrom cloudperf.cli import main\ntry:\n    main()\n' \
+           'except SystemExit:\n    pass'.format(args)
+    start = time.time()
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE, universal_newlines=True,
+                       cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    elapsed = time.time() - start
+    imports = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        imports[module.strip()] = int(cumulative)
+    return elapsed, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--args', default='--help', help='CLI arguments to run with')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='Show the slowest n imports')
+    opts = parser.parse_args()
+
+    args = shlex.split(opts.args)
+    times = []
+    for _ in range(opts.runs):
+        elapsed, imports = run(args)
+        times.append(elapsed)
+    print('cloudperf {}: median {:.3f}s, min {:.3f}s over {} runs, {} modules imported'.format(
+        opts.args, statistics.median(times), min(times), opts.runs, len(imports)))
+    for module, us in sorted(imports.items(), key=lambda i: -i[1])[:opts.top]:
+        print('{:>10.1f}ms  {}'.format(us/1000, module))
+
+    loaded = [m for m in forbidden if m in imports]
+    if loaded:
+        print('Imported {}, which should be lazy'.format(', '.join(loaded)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
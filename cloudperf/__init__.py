@@ -1,6 +1,6 @@
 from __future__ import absolute_import
-from .core import get_prices, get_performance, get_combined, prices_url, performance_url, terminate_instances
+from .core import Dataset, get_prices, get_performance, get_combined, prices_url, performance_url, terminate_instances
 
-__all__ = ['get_prices', 'get_performance', 'get_combined',
+__all__ = ['Dataset', 'get_prices', 'get_performance', 'get_combined',
            'prices_url', 'performance_url', 'terminate_instances']
 __version__ = '0.0.51'
@@ -0,0 +1,167 @@
+# The benchmark runner, which is uploaded to and started on the benchmarked
+# instances. It reads the benchmark plan (see aws_helpers.agent_plan) from a
+# JSON file, runs the whole sweep on the instance and appends a JSON line to
+# the results file for each measured point, so the results can be streamed
+# back over a single channel and they survive a dropped ssh connection.
+# This module must only use the standard library and stay compatible with the
+# python on the instances.
+from __future__ import absolute_import, division
+import io
+import os
+import sys
+import json
+import time
+import traceback
+import subprocess
+
+try:
+    from cloudperf.sampling import adaptive_cpu_sweep, run_until_stable
+except ImportError:
+    # uploaded next to this file
+    from sampling import adaptive_cpu_sweep, run_until_stable
+
+
+def mean(samples):
+    return sum(samples)/len(samples)
+
+
+def median(samples):
+    samples = sorted(samples)
+    mid = len(samples)//2
+    if len(samples) % 2:
+        return samples[mid]
+    return (samples[mid-1]+samples[mid])/2
+
+
+# score aggregation functions by name. These only drive the adaptive CPU
+# sampling here, the final scores are computed from the samples by the caller
+aggregations = {'max': max, 'min': min, 'mean': mean, 'median': median}
+
+
+def log(msg):
+    sys.stderr.write('{} {}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'), msg))
+    sys.stderr.flush()
+
+
+def run(cmd):
+    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    return p.returncode, stdout.decode('utf-8', 'replace'), stderr.decode('utf-8', 'replace')
+
+
+def run_checked(cmd):
+    ec, stdout, stderr = run(cmd)
+    if ec != 0:
+        raise RuntimeError("{} failed with {}: {}, {}".format(cmd, ec, stdout, stderr))
+
+
+def write_file(name, contents, mode=0o755):
+    with io.open(name, 'w', encoding='utf-8') as f:
+        f.write(contents)
+    os.chmod(name, mode)
+
+
+class Results(object):
+    def __init__(self, path):
+        self.f = open(path, 'a')
+
+    def emit(self, type, **record):
+        record.update({'type': type, 'time': time.time()})
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+
+def run_benchmark(bench, results):
+    name = bench['id']
+    for fname, contents in bench.get('files', {}).items():
+        write_file(fname, contents)
+
+    if bench.get('composefile'):
+        write_file('docker-compose.yml', bench['composefile'], 0o644)
+        run_checked('docker-compose up -d')
+        if bench.get('after_compose_up'):
+            write_file('after_compose_up', bench['after_compose_up'])
+            run_checked('./after_compose_up')
+
+    if 'timeout' in bench:
+        timeout_cmd = 'timeout -k {} {} '.format(bench['timeout']+5, bench['timeout'])
+    else:
+        timeout_cmd = ''
+    aggr_f = aggregations.get(bench.get('score_aggregation'), max)
+
+    def measure(numcpu):
+        run('sync')
+        cmd = '{}docker run --rm {} {} {}'.format(timeout_cmd, bench.get('docker_opts', '--network none'),
+                                                  bench['image'], bench['cmd'].format(numcpu=numcpu))
+        unparseable = []
+
+        def run_once():
+            log("Running command: {}".format(cmd))
+            ec, stdout, stderr = run(cmd)
+            if ec != 0:
+                log("Non-zero exit code {}, {}, {}".format(ec, stdout, stderr))
+                return None
+            try:
+                return float(stdout)
+            except ValueError:
+                log("Couldn't parse output: {}".format(stdout))
+                unparseable.append(stdout)
+                return None
+
+        if bench.get('cv_threshold'):
+            samples = run_until_stable(run_once, bench.get('min_iterations', 2),
+                                       bench.get('max_iterations', 10), bench['cv_threshold'])
+        else:
+            samples = run_until_stable(run_once, bench.get('iterations', 3))
+        results.emit('sample', benchmark_id=name, benchmark_cpus=numcpu, samples=samples,
+                     unparseable=bool(unparseable))
+        try:
+            return None if unparseable else aggr_f([s for s in samples if s is not None])
+        except Exception:
+            return None
+
+    if bench.get('cpus'):
+        for numcpu in bench['cpus']:
+            measure(numcpu)
+    elif bench.get('cpu_sampling') == 'adaptive':
+        measured = []
+        points = adaptive_cpu_sweep(bench['maxcpu'], measure, bench.get('cpu_tolerance', 0.05))
+        for numcpu, score, interpolated in points:
+            if not interpolated:
+                measured.append(numcpu)
+        for numcpu, score, interpolated in points:
+            if interpolated:
+                # tell which measured points this one lies between, so the
+                # caller can interpolate its own scores
+                results.emit('interpolated', benchmark_id=name, benchmark_cpus=numcpu,
+                             between=[max(n for n in measured if n < numcpu), min(n for n in measured if n > numcpu)])
+    else:
+        for numcpu in range(1, bench['maxcpu']+1):
+            measure(numcpu)
+
+    if bench.get('composefile'):
+        run_checked('docker-compose down -v')
+        if bench.get('after_compose_down'):
+            write_file('after_compose_down', bench['after_compose_down'])
+            run_checked('./after_compose_down')
+
+
+def main(plan_file, results_file):
+    with open(plan_file) as f:
+        plan = json.load(f)
+    results = Results(results_file)
+    try:
+        for bench in plan['benchmarks']:
+            try:
+                run_benchmark(bench, results)
+                results.emit('complete', benchmark_id=bench['id'])
+            except Exception:
+                log(traceback.format_exc())
+                results.emit('error', benchmark_id=bench['id'], error=traceback.format_exc())
+    finally:
+        results.emit('done')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2])
@@ -27,11 +27,33 @@
 #             the actual number of CPUs in the `numcpu` variable. For a 8 CPU
 #             machine it means 8 runs with `numcpu` being 1,2,3,4,5,6,7,8.
 #             `cpus` can be a python list, eg: 'cpus': [1,2,4,8,16]
+#   - `cpu_sampling`: if `cpus` is not specified and this is 'adaptive', the
+#                     command is run only for 1,2,4,... and the maximum number of
+#                     CPUs first, then the intervals between these are bisected
+#                     until the measured points fit on a line within
+#                     `cpu_tolerance` (relative, default: 0.05). The scores for
+#                     the rest of the CPU numbers are linearly interpolated and
+#                     marked with `benchmark_interpolated`.
 #   - `iterations`: the benchmark will be runned this many times (for each CPUs)
 #                   in order to have more measure points. Default: 3.
+#   - `cv_threshold`: if set, instead of a fixed number of `iterations` the
+#                     benchmark is repeated at least `min_iterations` (default: 2)
+#                     and at most `max_iterations` (default: 10) times, until the
+#                     coefficient of variation (stddev/mean) of the scores drops
+#                     below this value.
+#                     Benchmarks opt in to this, the existing ones keep their fixed
+#                     iterations, so their new results are comparable with the old.
+#                     All scores are stored in `benchmark_samples` (space separated,
+#                     nan for the failed runs), along with
+#                     their `benchmark_n`, `benchmark_stddev`, `benchmark_min` and
+#                     `benchmark_max`, regardless of this setting.
 #   - `score_aggregation`: this python function will be used to aggregating the
 #                          scores from the above iterations. The scores will be
 #                          passed as a list of floats. Default: max
+#                          The benchmarks are run by an agent (agent.py) on the
+#                          instances, which uses the function of the same name
+#                          (max, min, mean or median, falling back to max) for
+#                          `cpu_sampling`, while the scores are computed locally.
 
 crdb_tag = 'v2.1.5'
 stress_ng_tag = 'latest'
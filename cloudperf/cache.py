@@ -0,0 +1,194 @@
+from __future__ import absolute_import
+import os
+import json
+import time
+import glob
+import hashlib
+import logging
+import tempfile
+from logging import NullHandler
+
+logger = logging.getLogger(__name__)
+logger.addHandler(NullHandler())
+
+# downloaded files, their ETag/Last-Modified headers and the parsed DataFrames
+# are kept here
+cache_dir = os.environ.get('CLOUDPERF_CACHE_DIR',
+                           os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'cloudperf'))
+# evict the least recently used entries above this size (bytes)
+cache_size = int(os.environ.get('CLOUDPERF_CACHE_SIZE', 512*1024**2))
+# don't even revalidate an entry if it was checked in the last n seconds
+cache_max_age = int(os.environ.get('CLOUDPERF_CACHE_MAX_AGE', 300))
+fetch_timeout = 30
+
+
+def set_offline():
+    os.environ['CLOUDPERF_OFFLINE'] = '1'
+
+
+def offline():
+    if os.environ.get('CLOUDPERF_OFFLINE'):
+        return True
+    return False
+
+
+def set_disabled():
+    os.environ['CLOUDPERF_NO_CACHE'] = '1'
+
+
+def enabled():
+    if os.environ.get('CLOUDPERF_NO_CACHE') or cache_size <= 0:
+        return False
+    return True
+
+
+def entry_key(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def entry_paths(url):
+    key = entry_key(url)
+    # keep the original file name, so the format and compression can be
+    # detected from the body's name
+    name = os.path.basename(url.split('?', 1)[0]) or 'body'
+    base = os.path.join(cache_dir, key)
+    return {'body': '{}-{}'.format(base, name), 'meta': base + '.meta', 'frame': base + '.frame.pkl'}
+
+
+def load_meta(paths):
+    try:
+        with open(paths['meta']) as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def write_atomic(path, write):
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def touch(paths):
+    # mark the entry as recently used. Only the metadata is touched, the body
+    # and frame modification times tell whether the frame is up to date
+    if os.path.exists(paths['meta']):
+        os.utime(paths['meta'])
+
+
+def fetch(url):
+    """Make sure url's body is in the cache, revalidating it with a conditional
+    GET (If-None-Match/If-Modified-Since) if needed.
+
+    Returns:
+        tuple of the body's local path and whether it has changed
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    paths = entry_paths(url)
+    meta = load_meta(paths)
+    have_body = meta and os.path.exists(paths['body'])
+
+    if have_body and (offline() or time.time()-meta.get('checked', 0) < cache_max_age):
+        touch(paths)
+        return paths['body'], False
+    if offline():
+        raise IOError("{} is not cached and we're offline".format(url))
+
+    import requests
+
+    headers = {}
+    if have_body and meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if have_body and meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        r = requests.get(url, headers=headers, stream=True, timeout=fetch_timeout)
+        if r.status_code != 304:
+            r.raise_for_status()
+    except Exception as e:
+        if not have_body:
+            raise
+        logger.warning("Couldn't revalidate {}, using the cached copy: {}".format(url, e))
+        return paths['body'], False
+
+    if r.status_code == 304:
+        changed = False
+    else:
+        from cloudperf.core import get_comp
+        # compressed files are stored as is, the readers will decompress them
+        decode = get_comp(paths['body']) is None
+
+        def write_body(f):
+            for chunk in r.raw.stream(1024*1024, decode_content=decode):
+                f.write(chunk)
+        write_atomic(paths['body'], write_body)
+        meta = {'url': url, 'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}
+        changed = True
+    meta['checked'] = time.time()
+    write_atomic(paths['meta'], lambda f: f.write(json.dumps(meta).encode('utf-8')))
+    touch(paths)
+    if changed:
+        evict()
+    return paths['body'], changed
+
+
+def etag(url):
+    """Return the cached validator (ETag or Last-Modified) of url"""
+    meta = load_meta(entry_paths(url))
+    return meta.get('etag') or meta.get('last_modified')
+
+
+def read_frame(url, reader):
+    """Read url with reader (called with the local path of the body) and
+    keep the resulting DataFrame pickled, so until the body changes, it can
+    be loaded without downloading and parsing it again."""
+    import pandas as pd
+
+    body, changed = fetch(url)
+    paths = entry_paths(url)
+    if not changed and os.path.exists(paths['frame']) and \
+            os.path.getmtime(paths['frame']) >= os.path.getmtime(body):
+        try:
+            return pd.read_pickle(paths['frame'])
+        except Exception:
+            logger.info("Couldn't load cached frame for {}, parsing it again".format(url))
+    df = reader(body)
+    write_atomic(paths['frame'], lambda f: df.to_pickle(f))
+    evict()
+    return df
+
+
+def evict(max_size=None):
+    """Remove the least recently used entries until the cache's size is below
+    max_size"""
+    if max_size is None:
+        max_size = cache_size
+    entries = {}
+    for path in glob.glob(os.path.join(cache_dir, '*')):
+        key = os.path.basename(path)[:40]
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        size, used = entries.get(key, (0, 0))
+        entries[key] = (size+st.st_size, max(used, st.st_mtime))
+    total = sum(size for size, _ in entries.values())
+    for key, (size, _) in sorted(entries.items(), key=lambda i: i[1][1]):
+        if total <= max_size:
+            break
+        logger.info("Evicting {} from the cache".format(key))
+        for path in glob.glob(os.path.join(cache_dir, key + '*')):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        total -= size
+
+
+def clear():
+    evict(0)
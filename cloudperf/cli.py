@@ -1,14 +1,12 @@
 import os
-import re
 import sys
 import signal
 import traceback
 import click
-import pandas as pd
-import pytimeparse
-import boto3
-from cloudperf import get_prices, get_performance, get_combined, prices_url, performance_url, terminate_instances
-from cloudperf.core import fail_on_exit
+import cloudperf.cache
+from cloudperf import Dataset, get_prices, get_performance, prices_url, performance_url, terminate_instances
+from cloudperf.core import fail_on_exit, get_comp, get_format, format_file, write_df, prices_dtypes, performance_dtypes
+from cloudperf.core import scaling_file, plan_performance
 
 try:
     import faulthandler
@@ -18,67 +16,69 @@ except ImportError:
 
 
 @click.group()
-def main():
-    pass
+@click.option('--offline/--online', help='Only use the locally cached data files, never download them',
+              default=False, show_default=True)
+@click.option('--cache/--no-cache', help='Cache downloaded data files locally',
+              default=True, show_default=True)
+def main(offline, cache):
+    if offline:
+        cloudperf.cache.set_offline()
+    if not cache:
+        cloudperf.cache.set_disabled()
 
 
-def get_comp(file):
-    fn, ext = os.path.splitext(file)
-    comp = None
-    try:
-        ext = ext[1:]
-        if ext in ('gzip', 'bz2', 'zip', 'xz'):
-            comp = ext
-        if ext == 'gz':
-            comp = 'gzip'
-    except Exception:
-        pass
-    return comp
+content_types = {'parquet': 'application/vnd.apache.parquet',
+                 'feather': 'application/vnd.apache.arrow.file'}
+
 
+def s3_upload(s3_bucket, file, key=None, content_type=None, content_encoding=None):
+    import boto3
 
-def s3_upload(s3_bucket, file):
     comp = get_comp(file)
     s3 = boto3.resource('s3')
     bucket = s3.Bucket(s3_bucket)
-    if comp == 'gzip':
+    if key is None:
+        key = os.path.basename(file)
+    if content_type is not None:
+        extra_args = {'ACL': 'public-read', 'ContentType': content_type}
+        if content_encoding is not None:
+            extra_args['ContentEncoding'] = content_encoding
+        bucket.upload_file(file, key, ExtraArgs=extra_args)
+    elif get_format(file) in content_types:
+        bucket.upload_file(file, key,
+                           ExtraArgs={'ACL': 'public-read',
+                                      'ContentType': content_types[get_format(file)]})
+    elif comp == 'gzip':
         # upload with gzip Content-Encoding and proper Content-Type
-        bucket.upload_file(file, os.path.basename(file),
+        bucket.upload_file(file, key,
                            ExtraArgs={'ACL': 'public-read',
                                       'ContentType': 'application/json; charset=utf-8',
                                       'ContentEncoding': 'gzip'})
     elif comp:
-        bucket.upload_file(file, os.path.basename(
-            file), ExtraArgs={'ACL': 'public-read'})
+        bucket.upload_file(file, key, ExtraArgs={'ACL': 'public-read'})
     else:
-        bucket.upload_file(file, os.path.basename(
-            file), ExtraArgs={'ACL': 'public-read',
-                              'ContentType': 'application/json; charset=utf-8'})
-
-
-def df_filter(df, filters):
-    for f in filters:
-        m = re.search('(?P<col>[^=<>]+)(?P<op>[=<>]+)(?P<value>.*)', f)
-        if not m:
-            continue
-        try:
-            v = float(m.group('value'))
-        except Exception:
-            v = m.group('value')
-        if m.group('op') == '=':
-            df = df[df[m.group('col')] == v]
-        elif m.group('op') == '>':
-            df = df[df[m.group('col')] > v]
-        elif m.group('op') == '<':
-            df = df[df[m.group('col')] < v]
-        elif m.group('op') == '<=':
-            df = df[df[m.group('col')] <= v]
-        elif m.group('op') == '>=':
-            df = df[df[m.group('col')] >= v]
-    return df
+        bucket.upload_file(file, key, ExtraArgs={'ACL': 'public-read',
+                                                 'ContentType': 'application/json; charset=utf-8'})
+
+
+def write_data(df, file, s3_bucket, dtype, parquet):
+    files = [file]
+    write_df(df, file, dtype=dtype)
+    if parquet and get_format(file) != 'parquet':
+        files.append(format_file(file, 'parquet'))
+        write_df(df, files[-1], dtype=dtype)
+    if s3_bucket is not None:
+        for f in files:
+            s3_upload(s3_bucket, f)
+
+
+parquet_option = click.option('--parquet/--no-parquet',
+                              help='Also write (and upload) a Parquet copy next to the file',
+                              default=False, show_default=True)
 
 
 @main.command()
-@click.option('--prices', help='Prices URL (pandas.read_json)', default=prices_url, show_default=True)
+@click.option('--prices', help='Prices URL (JSON, Parquet or Arrow)', default=prices_url, show_default=True)
 @click.option('--file', help='Write prices to this file', required=True)
 @click.option('--s3-bucket', help='Write prices to this s3 bucket')
 @click.option('--update/--no-update',
@@ -87,20 +87,19 @@ def df_filter(df, filters):
 @click.option('--fail-on-missing-regions/--no-fail-on-missing-regions',
               help='Fail if there are missing regions in the region map',
               default=False, show_default=True)
-def write_prices(prices, file, s3_bucket, update, fail_on_missing_regions):
+@parquet_option
+def write_prices(prices, file, s3_bucket, update, fail_on_missing_regions, parquet):
     if not update:
         prices = None
     df = get_prices(prices, update, fail_on_missing_regions=fail_on_missing_regions)
-    df.to_json(file, orient='records', compression=get_comp(file), date_unit='s')
-    if s3_bucket is not None:
-        s3_upload(s3_bucket, file)
+    write_data(df, file, s3_bucket, prices_dtypes, parquet)
     if fail_on_exit():
         sys.exit(1)
 
 
 @main.command()
-@click.option('--prices', help='Prices URL (pandas.read_json)', default=prices_url, show_default=True)
-@click.option('--perf', help='Performance URL (pandas.read_json)', default=performance_url, show_default=True)
+@click.option('--prices', help='Prices URL (JSON, Parquet or Arrow)', default=prices_url, show_default=True)
+@click.option('--perf', help='Performance URL (JSON, Parquet or Arrow)', default=performance_url, show_default=True)
 @click.option('--file', help='Write performance data to this file', default='/tmp/performance.json.gz')
 @click.option('--s3-bucket', help='Write data to this s3 bucket')
 @click.option('--update/--no-update',
@@ -111,63 +110,113 @@ def write_prices(prices, file, s3_bucket, update, fail_on_missing_regions):
               help='Terminate tagged images at the end of the run to clean up leftover ones',
               default=False, show_default=True)
 @click.option('--tag', help='Add these tags to EC2 instances (key:value format)', multiple=True)
-def write_performance(prices, perf, file, s3_bucket, update, expire, terminate, tag):
+@click.option('--journal', help='Keep the results in this journal while running, so an interrupted run can be '
+              'resumed [default: FILE.journal]')
+@click.option('--scaling-file', 'scaling_file_', help='Write the scaling summary to this file [default: FILE-scaling]')
+@click.option('--trace-file', help='Append the timing of each benchmarking phase to this file (JSON lines)')
+@click.option('--prom-file', help='Write the phase timing metrics to this Prometheus textfile')
+@click.option('--plan', is_flag=True, help="Only show the instances which would be benchmarked, their estimated "
+              "runtimes (refined by the TRACE_FILE of earlier runs) and costs, without launching anything")
+@parquet_option
+def write_performance(prices, perf, file, s3_bucket, update, expire, terminate, tag, journal, scaling_file_,
+                      trace_file, prom_file, plan, parquet):
+    import pytimeparse
+    from cloudperf import metrics
+    from cloudperf.journal import Journal
+    from cloudperf.scaling import scaling_summary
+
     tags = [i.split(':', 1) for i in tag]
     # convert human readable to seconds
-    expire = pytimeparse.parse(expire)
-    comp = get_comp(file)
+    expire_seconds = pytimeparse.parse(expire)
+    if expire_seconds is None:
+        # don't re-run everything because of a typo
+        raise click.BadParameter("{!r} is not a duration (like 12w, 3d or 1h30m)".format(expire), param_hint='--expire')
+    expire = expire_seconds
     if not update:
         perf = None
+    if plan:
+        print_plan(prices, perf, update, expire, journal or file + '.journal', trace_file)
+        return
+    journal = Journal(journal or file + '.journal')
+    metrics.tracer.configure(trace_file, prom_file)
     try:
-        get_performance(prices, perf, update, expire, tags=tags).to_json(file, orient='records', compression=comp, date_unit='s')
-        if s3_bucket is not None:
-            s3_upload(s3_bucket, file)
+        df = get_performance(prices, perf, update, expire, tags=tags, journal=journal)
+        write_data(df, file, s3_bucket, performance_dtypes, parquet)
+        # the results are written, the next run should start from scratch
+        journal.remove()
+        write_data(scaling_summary(df), scaling_file_ or scaling_file(file), s3_bucket, performance_dtypes, parquet)
     except Exception:
         traceback.print_exc()
     finally:
         if terminate:
             terminate_instances()
+        metrics.tracer.close()
+        if metrics.tracer.spans:
+            print(metrics.tracer.summary())
     if fail_on_exit():
         sys.exit(1)
 
 
+def print_plan(prices, perf, update, expire, journal, trace_file):
+    import pandas as pd
+    from cloudperf import metrics
+    from cloudperf.journal import Journal
+
+    # don't create the journal and trace files just for planning
+    journal = Journal(journal) if os.path.exists(journal) else None
+    trace = metrics.read_trace(trace_file) if trace_file and os.path.exists(trace_file) else []
+    df = plan_performance(prices, perf, update, expire, journal=journal, trace=trace)
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None):
+        print(df.to_string(index=False))
+    print('{} instances, {:.1f} instance hours, {:.2f} USD, {:.1f} hours wall clock'.format(
+        len(df), df['runtime'].sum() / 3600, df['cost'].sum(), (df['end'].max() if len(df) else 0) / 3600))
+    print('The runtimes are upper estimates for the benchmarks repeated until the scores are stable (counted with '
+          'their max_iterations), adaptive CPU sweeps are counted with one bisection between the geometric points')
+
+
 @main.command()
-@click.option('--prices', help='Prices URL (pandas.read_json)', default=prices_url, show_default=True)
-@click.option('--perf', help='Performance URL (pandas.read_json)', default=performance_url, show_default=True)
+@click.option('--prices', help='Prices URL (JSON, Parquet or Arrow)', default=prices_url, show_default=True)
+@click.option('--perf', help='Performance URL (JSON, Parquet or Arrow)', default=performance_url, show_default=True)
 @click.option('--file', help='Write combined perf/price data to this file', default='/tmp/combined.json.gz')
 @click.option('--web-file', help='Write performance data for web serving to this file', default='/tmp/webperf.json')
+@click.option('--web-dir', help='Write the per benchmark and CPU architecture web shards into this directory',
+              default='/tmp/webperf', show_default=True)
 @click.option('--s3-bucket', help='Write data to this s3 bucket')
-def write_combined(prices, perf, file, web_file, s3_bucket):
-    comp = get_comp(file)
-    web_cols = ['instanceType', 'benchmark_id', 'vcpu', 'physicalProcessor']
+@parquet_option
+def write_combined(prices, perf, file, web_file, web_dir, s3_bucket, parquet):
+    from cloudperf.web import write_shards
 
-    get_combined(prices, perf).to_json(file, orient='records', compression=comp, date_unit='s')
-    if s3_bucket is not None:
-        s3_upload(s3_bucket, file)
-
-    df = get_combined(prices, perf, maxcpu=True)
-    comp = get_comp(web_file)
-    # only keep these columns for the web file and also reduce
-    # the output to one benchmark result per instance
-    df = df[web_cols + ['benchmark_score']].drop_duplicates(subset=web_cols)
-    df.to_json(web_file, orient='records', compression=comp, date_unit='s')
+    # load the sources only once for all files
+    ds = Dataset(prices, perf)
+    write_data(ds.combined(), file, s3_bucket, dict(prices_dtypes, **performance_dtypes), parquet)
+
+    write_df(ds.web(), web_file)
     if s3_bucket is not None:
         s3_upload(s3_bucket, web_file)
 
+    shard_files = write_shards(ds.combined(maxcpu=True), web_dir)
+    if s3_bucket is not None:
+        for path, key, content_type, content_encoding in shard_files:
+            s3_upload(s3_bucket, path, key, content_type, content_encoding)
+
     if fail_on_exit():
         sys.exit(1)
 
 
 @main.command()
-@click.option('--prices', help='Prices URL (pandas.read_json)', default=prices_url, show_default=True)
+@click.option('--prices', help='Prices URL (JSON, Parquet or Arrow)', default=prices_url, show_default=True)
 @click.option('--cols', help='Columns to show', default=['instanceType', 'region', 'spot-az',
                                                          'vcpu', 'memory', 'price'],
               show_default=True, multiple=True)
 @click.option('--sort', help='Sort by these columns', default=['price'], multiple=True, show_default=True)
-@click.option('--filter', help="Apply filters like --filter 'benchmark_cpus>4' --filter benchmark_id=sng_zlib", default=[], multiple=True)
+@click.option('--filter', help="Apply filters like --filter 'benchmark_cpus>4' --filter benchmark_id=sng_zlib "
+              "(operators: =, !=, <, >, <=, >=, ~ and !~ for regexes, lists like 'region=[us-east-1,us-west-2]')",
+              default=[], multiple=True)
 def prices(prices, cols, sort, filter):
-    df = get_prices(prices)
-    df = df_filter(df, filter)
+    import pandas as pd
+
+    # only read the columns we need
+    df = Dataset(prices=prices).prices(columns=set(cols) | set(sort), filters=filter)
     with pd.option_context('display.max_rows', None, 'display.max_columns', None):
         print(df.sort_values(list(sort))[list(cols)].to_string(index=False))
 
@@ -176,21 +225,28 @@ perf_defcols = ['instanceType', 'benchmark_id', 'benchmark_cpus']
 
 
 @main.command()
-@click.option('--prices', help='Prices URL (pandas.read_json)', default=prices_url, show_default=True)
-@click.option('--perf', help='Performance URL (pandas.read_json)', default=performance_url, show_default=True)
+@click.option('--prices', help='Prices URL (JSON, Parquet or Arrow)', default=prices_url, show_default=True)
+@click.option('--perf', help='Performance URL (JSON, Parquet or Arrow)', default=performance_url, show_default=True)
 @click.option('--cols', help='Columns to show', default=perf_defcols, show_default=True, multiple=True)
 @click.option('--sort', help='Sort by these columns', default=['perf/price'], multiple=True, show_default=True)
-@click.option('--filter', help="Apply filters like --filter 'benchmark_cpus>4' --filter benchmark_id=sng_zlib", default=[], multiple=True)
+@click.option('--filter', help="Apply filters like --filter 'benchmark_cpus>4' --filter benchmark_id=sng_zlib "
+              "(operators: =, !=, <, >, <=, >=, ~ and !~ for regexes, lists like 'region=[us-east-1,us-west-2]')",
+              default=[], multiple=True)
 @click.option('--combined/--no-combined',
               help='Show combined prices/performance data or just performance',
               default=True, show_default=True)
 @click.option('--maxcpu/--no-maxcpu',
               help='Show performance only for maximum number of CPUs',
               default=True, show_default=True)
-def performance(prices, perf, cols, sort, filter, combined, maxcpu):
+@click.option('--scaling', help='Read the maximum CPU results from this scaling summary URL (see the scaling '
+              'command) instead of the whole performance data')
+def performance(prices, perf, cols, sort, filter, combined, maxcpu, scaling):
+    import pandas as pd
+
     cols = list(cols)
+    ds = Dataset(prices, perf, scaling=scaling)
     if combined:
-        df = get_combined(prices, perf, maxcpu)
+        df = ds.combined(maxcpu, filters=filter)
         if set(cols) == set(perf_defcols):
             # if we're using the default columns, add perf/price and other
             # infos as well
@@ -200,11 +256,92 @@ def performance(prices, perf, cols, sort, filter, combined, maxcpu):
             cols = [seen.setdefault(x, x) for x in cols if x not in seen]
     else:
         sort = ['benchmark_score']
-        df = get_performance(prices, perf, maxcpu=maxcpu)
+        df = ds.performance(maxcpu, filters=filter)
         if set(cols) == set(perf_defcols):
             cols.extend(['benchmark_score'])
             seen = {}
             cols = [seen.setdefault(x, x) for x in cols if x not in seen]
-    df = df_filter(df, filter)
     with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.float_format', '{:.4f}'.format):
         print(df.sort_values(list(sort))[list(cols)].to_string(index=False))
+
+
+@main.command()
+@click.option('--prices', help='Prices URL (JSON, Parquet or Arrow)', default=prices_url, show_default=True)
+@click.option('--perf', help='Performance URL (JSON, Parquet or Arrow)', default=performance_url, show_default=True)
+@click.option('--host', help='Listen on this address', default='127.0.0.1', show_default=True)
+@click.option('--port', help='Listen on this port', default=8080, show_default=True)
+@click.option('--refresh', help='Check the sources for changes this often', default='5m', show_default=True)
+def serve(prices, perf, host, port, refresh):
+    import pytimeparse
+    import cloudperf.server
+
+    cloudperf.server.serve(prices, perf, host, port, pytimeparse.parse(refresh))
+
+
+@main.command()
+@click.option('--prices', help='Prices URL (JSON, Parquet or Arrow)', default=prices_url, show_default=True)
+@click.option('--perf', help='Performance URL (JSON, Parquet or Arrow)', default=performance_url, show_default=True)
+@click.option('--cols', help='Columns to show',
+              default=['instanceType', 'benchmark_id', 'benchmark_score', 'memory', 'vcpu', 'price', 'region', 'spot-az'],
+              show_default=True, multiple=True)
+@click.option('--sort', help='Rank by this column', default='price', show_default=True)
+@click.option('--desc/--asc', help='Rank in descending order', default=False, show_default=True)
+@click.option('--top', help='Show the best n rows', default=10, show_default=True)
+@click.option('--filter', help="Constraints, like --filter 'benchmark_score>=10000' --filter 'memory>=16' "
+              "(operators as in the performance command)", default=[], multiple=True)
+@click.option('--frontier/--no-frontier', help='Only consider the Pareto optimal rows of each benchmark',
+              default=False, show_default=True)
+@click.option('--objective', help='Objectives of the Pareto frontier (column:min or column:max)',
+              default=['benchmark_score:max', 'price:min', 'memory:max', 'vcpu:max'], show_default=True, multiple=True)
+@click.option('--spot-duration', help='Use the defined duration (hours) spot prices', type=float)
+def query(prices, perf, cols, sort, desc, top, filter, frontier, objective, spot_duration):
+    import pandas as pd
+    from cloudperf.query import top_k, parse_objectives
+
+    df = Dataset(prices, perf).combined(maxcpu=True, spot_duration=spot_duration)
+    df = top_k(df, top, sort, not desc, filter, frontier, parse_objectives(objective))
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.float_format', '{:.4f}'.format):
+        print(df[list(cols)].to_string(index=False))
+
+
+@main.command()
+@click.option('--prices', help='Prices URL (JSON, Parquet or Arrow)', default=prices_url, show_default=True)
+@click.option('--perf', help='Performance URL (JSON, Parquet or Arrow)', default=performance_url, show_default=True)
+@click.option('--benchmark', help='Size for this benchmark_id', required=True)
+@click.option('--target', help='The aggregate benchmark score the fleet should reach', type=float, required=True)
+@click.option('--max-node-cpus', help='Use at most this many CPUs per node', type=int)
+@click.option('--filter', help="Restrict the offers, like --filter 'region=us-east-1' --filter spot=False "
+              "(operators as in the performance command)", default=[], multiple=True)
+@click.option('--mixed/--no-mixed', help='Consider fleets of two instance types or offers', default=True,
+              show_default=True)
+@click.option('--top', help='Show the cheapest n fleets', default=10, show_default=True)
+def size(prices, perf, benchmark, target, max_node_cpus, filter, mixed, top):
+    import pandas as pd
+    from cloudperf.sizing import size_fleet
+
+    ds = Dataset(prices, perf)
+    df = size_fleet(ds.prices(), ds.performance(maxcpu=False), benchmark, target, max_node_cpus, filter, mixed, top)
+    cols = [c + n for n in ('_1', '_2') for c in ('instanceType', 'region', 'spot-az', 'node_cpus')]
+    cols = ['nodes_1'] + cols[:4] + ['nodes_2'] + cols[4:] + ['score', 'price']
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', None,
+                           'display.float_format', '{:.4f}'.format):
+        print(df[[c for c in cols if c in df]].to_string(index=False))
+
+
+@main.command()
+@click.option('--perf', help='Performance URL (JSON, Parquet or Arrow)', default=performance_url, show_default=True)
+@click.option('--scaling', help='Scaling summary URL, computed from --perf if not given')
+@click.option('--cols', help='Columns to show',
+              default=['instanceType', 'benchmark_id', 'benchmark_cpus', 'benchmark_score', 'score_1', 'efficiency',
+                       'efficiency_half', 'amdahl_serial', 'usl_sigma', 'usl_kappa', 'usl_peak_cpus'],
+              show_default=True, multiple=True)
+@click.option('--sort', help='Sort by these columns', default=['efficiency'], multiple=True, show_default=True)
+@click.option('--filter', help="Apply filters like --filter benchmark_id=sng_zlib --filter 'efficiency<0.6' "
+              "(operators as in the performance command)", default=[], multiple=True)
+def scaling(perf, scaling, cols, sort, filter):
+    import pandas as pd
+
+    df = Dataset(perf=perf, scaling=scaling).scaling(filters=filter)
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', None,
+                           'display.float_format', '{:.4f}'.format):
+        print(df.sort_values(list(sort))[list(cols)].to_string(index=False))
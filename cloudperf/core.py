@@ -1,10 +1,16 @@
 from __future__ import absolute_import
+import io
 import os
+import threading
 import importlib
+import urllib.parse
+import urllib.request
 import pkgutil
+import functools
 import cloudperf.providers
+from cloudperf import cache
+from cloudperf.filters import Filter
 import cachetools
-import pandas as pd
 
 prices_url = 'https://cloudperf-data.s3-us-west-2.amazonaws.com/prices.json.gz'
 performance_url = 'https://cloudperf-data.s3-us-west-2.amazonaws.com/performance.json.gz'
@@ -26,6 +32,135 @@ prices_dtypes = {
 }
 
 
+# compressions understood by pandas' JSON reader/writer
+json_compressions = ('gzip', 'bz2', 'zip', 'xz')
+# binary, columnar formats selected by the file extension
+file_formats = {
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.arrow': 'feather',
+    '.feather': 'feather',
+    '.ipc': 'feather',
+}
+
+
+def get_comp(file):
+    fn, ext = os.path.splitext(file)
+    comp = None
+    try:
+        ext = ext[1:]
+        if ext in json_compressions:
+            comp = ext
+        if ext == 'gz':
+            comp = 'gzip'
+    except Exception:
+        pass
+    return comp
+
+
+def is_url(file):
+    return isinstance(file, str) and urllib.parse.urlparse(file).scheme in ('http', 'https', 'ftp', 's3')
+
+
+def get_format(file):
+    # strip query strings from URLs and the compression suffix from the name
+    fn, ext = os.path.splitext(file.split('?', 1)[0])
+    if get_comp(file):
+        fn, ext = os.path.splitext(fn)
+    return file_formats.get(ext.lower(), 'json')
+
+
+def format_file(file, fmt):
+    """Return the name of file's sibling in the given format, eg.
+    /tmp/prices.json.gz -> /tmp/prices.parquet"""
+    fn, ext = os.path.splitext(file)
+    if get_comp(file):
+        fn, ext = os.path.splitext(fn)
+    ext = {'parquet': '.parquet', 'feather': '.arrow', 'json': '.json.gz'}[fmt]
+    return fn + ext
+
+
+def scaling_file(file):
+    """Return the name of the scaling summary written next to the performance
+    file, eg. /tmp/performance.json.gz -> /tmp/performance-scaling.json.gz"""
+    fn, ext = os.path.splitext(file)
+    if get_comp(file):
+        fn, ext2 = os.path.splitext(fn)
+        ext = ext2 + ext
+    return fn + '-scaling' + ext
+
+
+def read_df(file, dtype=None, columns=None, filters=None):
+    """Read a DataFrame from a JSON records, Parquet or Arrow IPC file (or
+    URL), chosen by the extension. columns limits the read to the given columns
+    (missing ones are ignored), which the columnar formats can skip on disk.
+    Only the rows matching filters (a Filter) are returned, Parquet files
+    skip the others while reading."""
+    import pandas as pd
+
+    filters = Filter(filters or ())
+    read_cols = None if columns is None else list(dict.fromkeys(list(columns) + filters.columns))
+
+    def project(df):
+        df = filters(df)
+        if columns is not None:
+            df = df[[c for c in columns if c in df]]
+        return df
+
+    if is_url(file) and file.startswith('http') and cache.enabled():
+        # read through the local cache
+        return project(cache.read_frame(file, functools.partial(read_df, dtype=dtype)))
+
+    fmt = get_format(file)
+    if fmt == 'json':
+        return project(pd.read_json(file, orient='records', dtype=dtype))
+
+    import pyarrow.ipc
+    import pyarrow.parquet
+    if is_url(file):
+        # pyarrow can't read URLs, so fetch the file into memory first
+        with urllib.request.urlopen(file) as r:
+            file = io.BytesIO(r.read())
+    if fmt == 'parquet':
+        names = pyarrow.parquet.read_schema(file).names
+    else:
+        names = pyarrow.ipc.open_file(file).schema.names
+    if read_cols is not None:
+        read_cols = [c for c in read_cols if c in names]
+    if fmt == 'parquet':
+        arrow_filters = filters.subset(names).arrow_filters()
+        try:
+            df = pd.read_parquet(file, columns=read_cols, filters=arrow_filters)
+        except (TypeError, ValueError, NotImplementedError, pyarrow.ArrowException):
+            # eg. comparing a string column with a number, leave it for
+            # the in-memory filter
+            if isinstance(file, io.BytesIO):
+                file.seek(0)
+            df = pd.read_parquet(file, columns=read_cols)
+    else:
+        df = pd.read_feather(file, columns=read_cols)
+    # categoricals are stored dictionary encoded, only convert what's not
+    if dtype:
+        df = df.astype({c: t for c, t in dtype.items() if c in df and df[c].dtype != t})
+    return project(df)
+
+
+def write_df(df, file, dtype=None):
+    """Write df to file in the format selected by its extension"""
+    fmt = get_format(file)
+    if fmt == 'json':
+        df.to_json(file, orient='records', compression=get_comp(file), date_unit='s')
+        return
+    if dtype:
+        # store these as dictionary encoded columns
+        df = df.astype({c: t for c, t in dtype.items() if c in df})
+    df = df.reset_index(drop=True)
+    if fmt == 'parquet':
+        df.to_parquet(file, index=False, compression='zstd')
+    else:
+        df.to_feather(file, compression='zstd')
+
+
 def set_fail_on_exit():
     os.environ['FAIL_ON_EXIT'] = '1'
 
@@ -78,20 +213,201 @@ def get_providers():
     return providers
 
 
-def get_prices(prices=None, update=False, fail_on_missing_regions=False):
+# conserve memory
+performance_cols = [
+    "provider",
+    "instanceType",
+    "benchmark_id",
+    "benchmark_cpus",
+    "benchmark_score",
+    "benchmark_interpolated",
+    "benchmark_n",
+    "benchmark_stddev",
+    "benchmark_min",
+    "benchmark_max",
+    "benchmark_samples",
+    "date",
+]
+# the scores of the repeated runs are kept in benchmark_samples separated by
+# this, so the column round-trips through all file formats. Failed runs are nan
+samples_separator = ' '
+# performance filters on these columns can be applied before reducing the
+# data to the maximum number of CPUs
+performance_keys = ['provider', 'instanceType', 'benchmark_id']
+# the prices and performance data are joined on these
+join_cols = ['provider', 'instanceType']
+web_cols = ['instanceType', 'benchmark_id', 'vcpu', 'physicalProcessor']
+# keep this many of the filtered views memoized (the least recently used ones
+# are dropped), the unfiltered ones are kept as long as the Dataset
+filtered_views = 256
+
+
+def format_samples(samples):
+    return samples_separator.join('nan' if s is None else repr(float(s)) for s in samples)
+
+
+def df_filter(df, filters):
+    return Filter(filters)(df)
+
+
+def freeze(value):
+    if value is None or isinstance(value, str):
+        return value
+    return tuple(value)
+
+
+def performance_view(df, maxcpu=False):
+    df = df[[c for c in performance_cols if c in df]]
+    if maxcpu:
+        return df.sort_values('benchmark_cpus', ascending=False).drop_duplicates(['instanceType', 'benchmark_id'])
+    return df
+
+
+class Dataset(object):
+    """Prices and performance data, loaded once from their sources.
+
+    The sources can be file names/URLs (see read_df), already loaded DataFrames
+    or None, in which case the data is fetched from the providers.
+    If the scaling summary source is given, the maxcpu performance data is
+    read from it instead of reducing the whole benchmark_cpus sweep, otherwise
+    the summary is computed from the performance data when needed.
+    The derived views (maxcpu performance, combined, web) are computed on first
+    use and memoized (the filtered ones in an LRU cache), so the returned
+    DataFrames must not be modified.
+    Filters are applied as early as possible, on the source data where they
+    don't change the result.
+    """
+
+    def __init__(self, prices=prices_url, perf=performance_url, fail_on_missing_regions=False, scaling=None):
+        self.sources = {'prices': prices, 'perf': perf, 'scaling': scaling}
+        self.dtypes = {'prices': prices_dtypes, 'perf': performance_dtypes, 'scaling': performance_dtypes}
+        self.fail_on_missing_regions = fail_on_missing_regions
+        self._views = {}
+        self._filtered_views = cachetools.LRUCache(maxsize=filtered_views)
+        self._lock = threading.RLock()
+
+    def _view(self, key, func, filters=()):
+        views = self._filtered_views if filters else self._views
+        with self._lock:
+            if key not in views:
+                views[key] = func()
+            return views[key]
+
+    def load(self, name, columns=None, filters=None):
+        """Return the raw data of the name (prices, perf or scaling) source,
+        limited to the rows matching filters (a Filter)"""
+        import pandas as pd
+
+        filters = Filter(filters or ())
+
+        def read():
+            src = self.sources[name]
+            if ('load', name, None, ()) in self._views:
+                # we already have all the data
+                df = filters(self._views[('load', name, None, ())])
+                return df if columns is None else df[[c for c in columns if c in df]]
+            if isinstance(src, pd.DataFrame):
+                df = filters(src)
+                return df if columns is None else df[[c for c in columns if c in df]]
+            if src:
+                return read_df(src, dtype=self.dtypes[name], columns=columns, filters=filters)
+            if name == 'scaling':
+                from cloudperf.scaling import scaling_summary
+                df = filters(scaling_summary(self.load('perf', filters=filters.subset(performance_keys))))
+                return df if columns is None else df[[c for c in columns if c in df]]
+            if name == 'prices':
+                return filters(pd.concat([cp.get_prices(fail_on_missing_regions=self.fail_on_missing_regions)
+                                          for cp in get_providers()], ignore_index=True, sort=False))
+            return pd.DataFrame(columns=performance_cols)
+
+        return self._view(('load', name, freeze(columns), filters.key), read, filters)
+
+    def prices(self, columns=None, filters=()):
+        filters = Filter(filters)
+
+        def view():
+            load_cols = None if columns is None else set(columns) | set(filters.columns)
+            df = self.load('prices', load_cols, filters)
+            return df if columns is None else df[[c for c in columns if c in df]]
+
+        return self._view(('prices', freeze(columns), filters.key), view, filters)
+
+    def performance(self, maxcpu=False, columns=None, filters=()):
+        filters = Filter(filters)
+
+        def view():
+            # filters on the keys can go before, the others after the maxcpu reduction
+            early, late = filters.split(performance_keys)
+            if maxcpu and self.sources['scaling'] is not None:
+                df = late(performance_view(self.load('scaling', filters=early)))
+            else:
+                df = late(performance_view(self.load('perf', filters=early), maxcpu))
+            return df if columns is None else df[[c for c in columns if c in df]]
+
+        return self._view(('performance', maxcpu, freeze(columns), filters.key), view, filters)
+
+    def scaling(self, filters=()):
+        """The scaling summary, one row per instance type and benchmark (see
+        cloudperf.scaling.scaling_summary)"""
+        return self.load('scaling', filters=filters)
+
+    def combined(self, maxcpu=False, spot_duration=None, filters=()):
+        filters = Filter(filters)
+
+        def view():
+            perf_df = self.performance(maxcpu=maxcpu)
+            perf_filters, rest = filters.split(perf_df.columns)
+            # columns which are in both frames are taken from the performance
+            # data, except the join columns, which can be filtered in both
+            prices_filters, rest = rest.split(set(self.load('prices').columns) - set(perf_df.columns))
+            perf_df = self.performance(maxcpu=maxcpu, filters=perf_filters)
+            # the negations would keep the rows left without prices by the
+            # merge, these go after it
+            pushed, _ = prices_filters.split_negations()
+            prices_df = self.prices(filters=pushed + perf_filters.subset(join_cols))
+            combined_df = perf_df.merge(prices_df, how='left', on=join_cols, suffixes=('', '_prices'),
+                                        indicator=True)
+            if prices_filters:
+                # the rows without matching prices can't match the prices
+                # filters, not even the negations
+                combined_df = combined_df[combined_df['_merge'] == 'both']
+            combined_df = combined_df.drop(columns='_merge')
+            if spot_duration:
+                combined_df = combined_df.dropna(subset=['spot'])
+                duration_field = f'price_{spot_duration:.0f}h'
+                if duration_field in combined_df:
+                    combined_df.loc[combined_df.spot, 'price'] = combined_df[duration_field]
+
+            combined_df['perf/price/cpu'] = combined_df['benchmark_score']/combined_df['price']/combined_df['benchmark_cpus']
+            combined_df['perf/price'] = combined_df['benchmark_score']/combined_df['price']
+            # the prices filters must be applied again on the rows with prices
+            # filtered out before the merge
+            return (prices_filters + rest)(combined_df)
+
+        return self._view(('combined', maxcpu, spot_duration, filters.key), view, filters)
+
+    def web(self):
+        """Performance data for web serving: one benchmark result per instance"""
+        def view():
+            df = self.combined(maxcpu=True)
+            return df[web_cols + ['benchmark_score']].drop_duplicates(subset=web_cols)
+
+        return self._view(('web',), view)
+
+
+def get_prices(prices=None, update=False, fail_on_missing_regions=False, columns=None):
+    ds = Dataset(prices=prices, fail_on_missing_regions=fail_on_missing_regions)
     # if we got a stored file and update is True, merge the two by overwriting
     # old data with new (and leaving not updated old data intact)
     if prices and update:
-        old = pd.read_json(prices, orient='records', dtype=prices_dtypes)
-        new = pd.concat([cp.get_prices(fail_on_missing_regions=fail_on_missing_regions) for cp in get_providers()], ignore_index=True, sort=False)
+        old = ds.load('prices')
+        new = Dataset(prices=None, fail_on_missing_regions=fail_on_missing_regions).prices()
         if new.empty:
             return old
         # update rows which have the same values in the following columns
         indices = ['provider', 'instanceType', 'region', 'spot', 'spot-az']
         return new.set_index(indices).combine_first(old.set_index(indices)).reset_index()
-    if prices:
-        return pd.read_json(prices, orient='records', dtype=prices_dtypes)
-    return pd.concat([cp.get_prices(fail_on_missing_regions=fail_on_missing_regions) for cp in get_providers()], ignore_index=True, sort=False)
+    return ds.prices(columns=columns)
 
 
 def args_cache_key(*args, **kw):
@@ -107,14 +423,18 @@ def args_cache_key(*args, **kw):
     return tuple(args)
 
 
-def get_performance(prices=None, perf=None, update=False, expire=False, tags=[], maxcpu=False):
+def get_performance(prices=None, perf=None, update=False, expire=False, tags=[], maxcpu=False, dataset=None,
+                    journal=None):
+    import pandas as pd
+
+    ds = dataset or Dataset(prices=prices, perf=perf)
     # if we got a stored file and update is True, merge the two by overwriting
     # old data with new (and leaving not updated old data intact).
     # if expire is set only update old data if the expiry period is passed
     if perf and update:
-        old = pd.read_json(perf, orient='records', dtype=performance_dtypes)
-        new = pd.concat([cp.get_performance(get_prices(prices), old, update, expire, tags=tags) for cp in get_providers()],
-                        ignore_index=True, sort=False)
+        old = ds.load('perf')
+        new = pd.concat([cp.get_performance(ds.prices(), old, update, expire, tags=tags, journal=journal)
+                         for cp in get_providers()], ignore_index=True, sort=False)
         if new.empty:
             resdf = old
         else:
@@ -122,39 +442,30 @@ def get_performance(prices=None, perf=None, update=False, expire=False, tags=[],
             indices = ['provider', 'instanceType', 'benchmark_id', 'benchmark_cpus']
             resdf = new.set_index(indices).combine_first(old.set_index(indices)).reset_index()
     elif perf:
-        resdf = pd.read_json(perf, orient='records', dtype=performance_dtypes)
+        return ds.performance(maxcpu=maxcpu)
     else:
-        resdf = pd.concat([cp.get_performance(get_prices(prices), tags=tags) for cp in get_providers()], ignore_index=True, sort=False)
-
-    # conserve memory
-    keep_cols = [
-        "provider",
-        "instanceType",
-        "benchmark_id",
-        "benchmark_cpus",
-        "benchmark_score",
-        "date",
-    ]
-    if maxcpu:
-        return resdf.sort_values('benchmark_cpus', ascending=False).drop_duplicates(['instanceType', 'benchmark_id'])[keep_cols]
-    else:
-        return resdf[keep_cols]
+        resdf = pd.concat([cp.get_performance(ds.prices(), tags=tags, journal=journal) for cp in get_providers()],
+                          ignore_index=True, sort=False)
+
+    return performance_view(resdf, maxcpu)
+
 
+def plan_performance(prices=None, perf=None, update=False, expire=False, journal=None, trace=(), dataset=None):
+    """Return what get_performance would run, without running anything: the
+    instances with their estimated runtimes, costs and start and end times
+    (seconds from the start). trace is the span records of earlier runs (see
+    cloudperf.metrics.read_trace), used to refine the runtime estimates."""
+    import pandas as pd
 
-def get_combined(prices=prices_url, perf=performance_url, maxcpu=False, spot_duration=None):
-    prices_df = get_prices(prices=prices)
-    perf_df = get_performance(prices=prices, perf=perf, maxcpu=maxcpu)
-    combined_df = perf_df.merge(prices_df, how='left', on=['provider', 'instanceType'], suffixes=('', '_prices'))
-    if spot_duration:
-        combined_df = combined_df.dropna(subset=['spot'])
-        duration_field = f'price_{spot_duration:.0f}h'
-        if duration_field in combined_df:
-            combined_df.loc[combined_df.spot, 'price'] = combined_df[duration_field]
+    ds = dataset or Dataset(prices=prices, perf=perf)
+    old = ds.load('perf') if perf and update else None
+    return pd.concat([cp.plan_performance(ds.prices(), old, update, expire, journal=journal, trace=trace)
+                      for cp in get_providers()], ignore_index=True, sort=False)
 
-    combined_df['perf/price/cpu'] = combined_df['benchmark_score']/combined_df['price']/combined_df['benchmark_cpus']
-    combined_df['perf/price'] = combined_df['benchmark_score']/combined_df['price']
 
-    return combined_df
+def get_combined(prices=prices_url, perf=performance_url, maxcpu=False, spot_duration=None, dataset=None):
+    ds = dataset or Dataset(prices=prices, perf=perf)
+    return ds.combined(maxcpu=maxcpu, spot_duration=spot_duration)
 
 
 def terminate_instances():
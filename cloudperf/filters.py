@@ -0,0 +1,187 @@
+from __future__ import absolute_import
+import re
+import operator
+import cachetools
+
+# col=value, col!=value, col>value, col<value, col>=value, col<=value,
+# col=[a,b,c] (in), col!=[a,b,c] (not in), col~regex and col!~regex
+filter_re = re.compile('(?P<col>[^=<>!~]+)(?P<op>==|!=|!~|<=|>=|=|<|>|~)(?P<value>.*)')
+comparisons = {'=': operator.eq, '!=': operator.ne, '<': operator.lt, '>': operator.gt,
+               '<=': operator.le, '>=': operator.ge}
+numexpr_ops = {'=': '==', '!=': '!=', '<': '<', '>': '>', '<=': '<=', '>=': '>='}
+# only the ones which can't drop rows with missing values, which the
+# in-memory evaluation would keep
+arrow_ops = {'=': '=', '<': '<', '>': '>', '<=': '<=', '>=': '>='}
+negations = ('!=', '!~')
+
+
+@cachetools.cached(cache={})
+def get_numexpr():
+    try:
+        import numexpr
+        return numexpr
+    except ImportError:
+        return None
+
+
+def parse_value(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+class Predicate(object):
+    def __init__(self, col, op, value):
+        self.col = col
+        self.op = '=' if op == '==' else op
+        if self.op in ('~', '!~'):
+            self.value = re.compile(value)
+        elif value.startswith('[') and value.endswith(']'):
+            if self.op not in ('=', '!='):
+                raise ValueError("Lists can only be used with = and !=: {}{}{}".format(col, op, value))
+            self.value = [parse_value(v.strip()) for v in value[1:-1].split(',') if v.strip()]
+        else:
+            self.value = parse_value(value)
+        self.text = '{}{}{}'.format(col, op, value)
+
+    def evaluate(self, values):
+        """Evaluate the predicate on values (a Series or the categories of a
+        categorical column), returning a boolean array"""
+        import numpy as np
+        import pandas as pd
+
+        if self.op in ('~', '!~'):
+            res = pd.Series(values, copy=False).astype(str).str.contains(self.value, regex=True).to_numpy(dtype=bool)
+        elif isinstance(self.value, list):
+            res = pd.Series(values, copy=False).isin(self.value).to_numpy()
+        elif pd.api.types.is_bool_dtype(values) and isinstance(self.value, str):
+            value = self.value.lower() in ('true', 'yes', '1')
+            return np.asarray(comparisons[self.op](values, value), dtype=bool)
+        else:
+            return np.asarray(comparisons[self.op](values, self.value), dtype=bool)
+        return ~res if self.op == '!~' or (self.op == '!=' and isinstance(self.value, list)) else res
+
+    def column_mask(self, col):
+        import numpy as np
+        import pandas as pd
+
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            # evaluate on the categories only and look up the rows by their
+            # codes. Missing values (code -1) only match the negations
+            matches = np.append(self.evaluate(col.cat.categories), self.op in negations)
+            return matches[col.cat.codes.to_numpy()]
+        return self.evaluate(col)
+
+    def numexpr_capable(self, col):
+        return (get_numexpr() is not None and self.op in numexpr_ops and isinstance(self.value, float)
+                and col.dtype.kind in 'iuf')
+
+    def arrow_filter(self):
+        if isinstance(self.value, list) and self.op == '=':
+            return (self.col, 'in', self.value)
+        if self.op in arrow_ops and not isinstance(self.value, list):
+            return (self.col, arrow_ops[self.op], self.value)
+        return None
+
+    def __str__(self):
+        return self.text
+
+
+class Filter(object):
+    """Filters (like benchmark_cpus>4 or region=us-west-2) compiled into one
+    vectorized expression.
+
+    Categorical columns are filtered on their codes, numerical comparisons are
+    evaluated in one pass with numexpr if it's installed. Strings which don't
+    look like a filter are ignored.
+    """
+
+    def __init__(self, filters=()):
+        if isinstance(filters, Filter):
+            self.predicates = list(filters.predicates)
+            return
+        self.predicates = []
+        for f in filters:
+            m = filter_re.search(f)
+            if m:
+                self.predicates.append(Predicate(m.group('col'), m.group('op'), m.group('value')))
+
+    @classmethod
+    def from_predicates(cls, predicates):
+        f = cls()
+        f.predicates = list(predicates)
+        return f
+
+    @property
+    def columns(self):
+        """The columns used by the filters"""
+        return list(dict.fromkeys(p.col for p in self.predicates))
+
+    @property
+    def key(self):
+        return tuple(str(p) for p in self.predicates)
+
+    def subset(self, cols):
+        """Return the filters which can be applied on cols"""
+        cols = set(cols)
+        return Filter.from_predicates(p for p in self.predicates if p.col in cols)
+
+    def split(self, cols):
+        """Split the filters to the ones which can be applied on cols and the
+        rest"""
+        cols = set(cols)
+        return self.subset(cols), Filter.from_predicates(p for p in self.predicates if p.col not in cols)
+
+    def split_negations(self):
+        """Split the filters to the ones which drop the rows with missing
+        values and the negations, which keep them"""
+        return (Filter.from_predicates(p for p in self.predicates if p.op not in negations),
+                Filter.from_predicates(p for p in self.predicates if p.op in negations))
+
+    def arrow_filters(self):
+        """Return the filters which can be pushed down to pyarrow's readers
+        (rows not matching these can be skipped) or None"""
+        filters = [f for f in (p.arrow_filter() for p in self.predicates) if f is not None]
+        return filters or None
+
+    def mask(self, df):
+        import numpy as np
+
+        mask = np.ones(len(df), dtype=bool)
+        terms = []
+        local_dict = {}
+        for i, p in enumerate(self.predicates):
+            col = df[p.col]
+            if p.numexpr_capable(col):
+                local_dict.update({'c{}'.format(i): col.to_numpy(), 'v{}'.format(i): p.value})
+                terms.append('(c{0} {1} v{0})'.format(i, numexpr_ops[p.op]))
+            else:
+                mask &= p.column_mask(col)
+        if terms:
+            mask &= get_numexpr().evaluate(' & '.join(terms), local_dict=local_dict)
+        return mask
+
+    def __call__(self, df):
+        """Return the rows of df matching all filters"""
+        if not self.predicates:
+            return df
+        return df[self.mask(df)]
+
+    def __add__(self, other):
+        return Filter.from_predicates(self.predicates + Filter(other).predicates)
+
+    def __len__(self):
+        return len(self.predicates)
+
+    def __iter__(self):
+        return iter(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, Filter) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return 'Filter({!r})'.format(list(self.key))
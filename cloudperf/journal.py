@@ -0,0 +1,94 @@
+from __future__ import absolute_import
+import os
+import json
+import sqlite3
+import logging
+import threading
+from logging import NullHandler
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+logger.addHandler(NullHandler())
+
+
+class Journal(object):
+    """Durable store for the results of a benchmark run.
+
+    Each result is committed as soon as it's produced and the benchmarks are
+    marked completed per instance type when they've finished, so an
+    interrupted run can be restarted without redoing the finished ones."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS results '
+                            '(id INTEGER PRIMARY KEY, provider TEXT, instanceType TEXT, benchmark_id TEXT, '
+                            'record TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS completed '
+                            '(provider TEXT, instanceType TEXT, benchmark_id TEXT, '
+                            'PRIMARY KEY (provider, instanceType, benchmark_id))')
+
+    def scope(self, provider):
+        return ProviderJournal(self, provider)
+
+    def append(self, provider, record):
+        record = dict(record, date=record['date'].isoformat())
+        with self.lock, self.db:
+            self.db.execute('INSERT INTO results (provider, instanceType, benchmark_id, record) VALUES (?, ?, ?, ?)',
+                            (provider, record['instanceType'], record['benchmark_id'], json.dumps(record)))
+
+    def complete(self, provider, instance_type, benchmark_id):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO completed VALUES (?, ?, ?)',
+                            (provider, instance_type, benchmark_id))
+
+    def completed(self, provider):
+        """Return the set of (instanceType, benchmark_id) tuples completed for
+        provider"""
+        with self.lock:
+            return set(self.db.execute('SELECT instanceType, benchmark_id FROM completed WHERE provider = ?',
+                                       (provider,)))
+
+    def frame(self, provider):
+        """Return provider's results. If a benchmark has been (partially) run
+        more than once, its latest results are kept."""
+        with self.lock:
+            records = [json.loads(r) for r, in self.db.execute(
+                'SELECT record FROM results WHERE provider = ? ORDER BY id', (provider,))]
+        if not records:
+            return pd.DataFrame({})
+        df = pd.DataFrame.from_records(records)
+        df['date'] = pd.to_datetime(df['date'])
+        return df.drop_duplicates(subset=['instanceType', 'benchmark_id', 'benchmark_cpus'],
+                                  keep='last').reset_index(drop=True)
+
+    def remove(self):
+        """Close and delete the journal, once its results are safely written"""
+        with self.lock:
+            self.db.close()
+        for path in (self.path, self.path + '-wal', self.path + '-shm'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+class ProviderJournal(object):
+    """A Journal's view of one provider's results"""
+
+    def __init__(self, journal, provider):
+        self.journal = journal
+        self.provider = provider
+
+    def append(self, record):
+        self.journal.append(self.provider, record)
+
+    def complete(self, instance_type, benchmark_id):
+        self.journal.complete(self.provider, instance_type, benchmark_id)
+
+    def completed(self):
+        return self.journal.completed(self.provider)
+
+    def frame(self):
+        return self.journal.frame(self.provider)
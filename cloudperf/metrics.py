@@ -0,0 +1,211 @@
+from __future__ import absolute_import
+import os
+import re
+import json
+import time
+import logging
+import threading
+import contextlib
+import collections
+from logging import NullHandler
+
+logger = logging.getLogger(__name__)
+logger.addHandler(NullHandler())
+
+# the tags the Prometheus metrics are labelled with, the others (eg.
+# benchmark_id, instance id) are only in the trace
+prometheus_labels = ('instanceType', 'arch', 'spot', 'outcome')
+# rewrite the Prometheus textfile at most this often (seconds) while running
+prometheus_interval = 60
+summary_quantiles = (0.5, 0.95)
+
+
+class Span(object):
+    """A timed phase with its tags. The outcome is ok, unless set otherwise
+    or the phase raised an exception."""
+
+    def __init__(self, name, tags, start=None):
+        self.name = name
+        self.tags = tags
+        self.start = time.time() if start is None else start
+        self.end = None
+
+    def tag(self, **tags):
+        self.tags.update(tags)
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def record(self):
+        return {'span': self.name, 'start': self.start, 'end': self.end, 'duration': self.duration,
+                'tags': self.tags}
+
+
+class Tracer(object):
+    """Collects the spans of all threads. The tags set by context() are added
+    to the spans started in the same thread. Finished spans are appended to
+    the trace file (JSON lines) as they end, the Prometheus textfile is
+    rewritten periodically and on close()."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spans = []
+        self.trace = None
+        self.prom_file = None
+        self.prom_written = 0
+
+    def configure(self, trace_file=None, prom_file=None):
+        with self.lock:
+            self.trace = open(trace_file, 'a') if trace_file else None
+            self.prom_file = prom_file
+
+    def context_tags(self):
+        return getattr(self.local, 'tags', {})
+
+    @contextlib.contextmanager
+    def context(self, **tags):
+        old = self.context_tags()
+        self.local.tags = dict(old, **tags)
+        try:
+            yield
+        finally:
+            self.local.tags = old
+
+    def tag(self, **tags):
+        """Update the current context's tags"""
+        self.local.tags = dict(self.context_tags(), **tags)
+
+    def set_tags(self, **tags):
+        """Replace the current context's tags"""
+        self.local.tags = tags
+
+    @contextlib.contextmanager
+    def span(self, name, **tags):
+        span = Span(name, dict(self.context_tags(), outcome='ok'))
+        span.tag(**tags)
+        try:
+            yield span
+        except Exception:
+            span.tag(outcome='error')
+            raise
+        finally:
+            self.finish(span)
+
+    def record(self, name, start, end, **tags):
+        """Add an already finished span, eg. one timed on the instance"""
+        span = Span(name, dict(self.context_tags(), outcome='ok'), start)
+        span.tag(**tags)
+        self.finish(span, end)
+
+    def finish(self, span, end=None):
+        span.end = time.time() if end is None else end
+        with self.lock:
+            self.spans.append(span)
+            if self.trace is not None:
+                self.trace.write(json.dumps(span.record(), default=str) + '\n')
+                self.trace.flush()
+        if self.prom_file and time.time() - self.prom_written > prometheus_interval:
+            try:
+                self.write_prometheus()
+            except Exception:
+                logger.exception("Couldn't write {}".format(self.prom_file))
+
+    def write_prometheus(self, path=None):
+        path = path or self.prom_file
+        if not path:
+            return
+        with self.lock:
+            spans = list(self.spans)
+            self.prom_written = time.time()
+        # write and rename, so the collector never sees a partial file
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(prometheus_text(spans))
+        os.rename(tmp, path)
+
+    def summary(self):
+        with self.lock:
+            return summary_table(list(self.spans))
+
+    def close(self):
+        self.write_prometheus()
+        with self.lock:
+            if self.trace is not None:
+                self.trace.close()
+                self.trace = None
+
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(spans):
+    """Render the spans' totals in the Prometheus text format"""
+    totals = collections.defaultdict(lambda: [0, 0.0, 0])
+    for span in spans:
+        labels = tuple((k, span.tags[k]) for k in prometheus_labels if span.tags.get(k) is not None)
+        total = totals[(span.name, labels)]
+        total[0] += 1
+        total[1] += span.duration
+        total[2] += span.tags.get('retries') or 0
+    metrics = [('cloudperf_phase_count', 'Number of finished benchmarking phases', 0),
+               ('cloudperf_phase_seconds_total', 'Time spent in the benchmarking phases', 1),
+               ('cloudperf_phase_retries_total', 'Retries in the benchmarking phases', 2)]
+    lines = []
+    for metric, help, i in metrics:
+        lines.append('# HELP {} {}'.format(metric, help))
+        lines.append('# TYPE {} counter'.format(metric))
+        for (name, labels), total in sorted(totals.items(), key=lambda t: (t[0][0], str(t[0][1]))):
+            label = ','.join('{}="{}"'.format(re.sub('[^a-zA-Z0-9_]', '_', k), prometheus_label(v))
+                             for k, v in (('phase', name),) + labels)
+            lines.append('{}{{{}}} {}'.format(metric, label, total[i]))
+    return '\n'.join(lines) + '\n'
+
+
+def read_trace(path):
+    """Return the span records of a trace file, skipping the partially
+    written line of an interrupted run"""
+    spans = []
+    with open(path) as f:
+        for line in f:
+            try:
+                spans.append(json.loads(line))
+            except ValueError:
+                logger.warning("Skipping the invalid trace line {!r}".format(line[:80]))
+    return spans
+
+
+def quantile(values, q):
+    values = sorted(values)
+    return values[min(len(values)-1, int(q*len(values)))]
+
+
+def summary_table(spans):
+    """Return the per phase statistics of the spans as text"""
+    phases = collections.OrderedDict()
+    for span in sorted(spans, key=lambda s: s.start):
+        phases.setdefault(span.name, []).append(span)
+    header = ['phase', 'n', 'total', 'mean'] + ['p{:.0f}'.format(q*100) for q in summary_quantiles] + \
+        ['max', 'retries', 'failed']
+    rows = []
+    for name, phase_spans in phases.items():
+        durations = [s.duration for s in phase_spans]
+        rows.append([name, len(durations), sum(durations), sum(durations)/len(durations)] +
+                    [quantile(durations, q) for q in summary_quantiles] +
+                    [max(durations), sum(s.tags.get('retries') or 0 for s in phase_spans),
+                     sum(1 for s in phase_spans if s.tags.get('outcome') != 'ok')])
+    lines = ['{:<14}'.format(header[0]) + ''.join('{:>10}'.format(h) for h in header[1:])]
+    for row in rows:
+        lines.append('{:<14}{:>10}'.format(row[0], row[1]) + ''.join('{:>10.1f}'.format(v) for v in row[2:-2]) +
+                     '{:>10}{:>10}'.format(row[-2], row[-1]))
+    return '\n'.join(lines)
+
+
+tracer = Tracer()
+span = tracer.span
+context = tracer.context
+tag = tracer.tag
+set_tags = tracer.set_tags
+record = tracer.record
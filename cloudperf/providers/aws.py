@@ -100,19 +100,32 @@ class CloudProvider(object):
 
         return instances
 
-    def get_performance(self, prices_df, perf_df=None, update=None, expire=None, tags=[], **filters):
+    def get_performance(self, prices_df, perf_df=None, update=None, expire=None, tags=[], journal=None, **filters):
         if not filters:
             filters = self.filters
         # only pass our records
         prices_df = prices_df[prices_df['provider'] == self.provider]
         if perf_df is not None:
             perf_df = perf_df[perf_df['provider'] == self.provider]
-        instances = aws_helpers.get_ec2_performance(prices_df, perf_df, update, expire, tags, **filters)
+        if journal is not None:
+            # keep our results separate from the other providers'
+            journal = journal.scope(self.provider)
+        instances = aws_helpers.get_ec2_performance(prices_df, perf_df, update, expire, tags, journal, **filters)
         if instances.empty:
             return instances
         # add a provider column
         instances['provider'] = self.provider
         return instances
 
+    def plan_performance(self, prices_df, perf_df=None, update=None, expire=None, journal=None, trace=()):
+        prices_df = prices_df[prices_df['provider'] == self.provider]
+        if perf_df is not None:
+            perf_df = perf_df[perf_df['provider'] == self.provider]
+        if journal is not None:
+            journal = journal.scope(self.provider)
+        plan = aws_helpers.plan_ec2_performance(prices_df, perf_df, update, expire, journal, trace)
+        plan['provider'] = self.provider
+        return plan
+
     def terminate_instances(self):
         aws_helpers.terminate_instances()
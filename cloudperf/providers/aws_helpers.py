@@ -4,6 +4,10 @@ import re
 import sys
 import json
 import time
+import array
+import random
+import socket
+import pkgutil
 import threading
 import logging
 import functools
@@ -12,16 +16,20 @@ from logging import NullHandler
 import copy
 from datetime import datetime, date
 from io import StringIO
-from multiprocessing.pool import ThreadPool
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import boto3
 import cachetools
 import requests
 import paramiko
+import numpy as np
 import pandas as pd
 from dateutil import parser
 from botocore.exceptions import ClientError
 from cloudperf.benchmarks import benchmarks
-from cloudperf.core import sftp_write_file, DictQuery, set_fail_on_exit
+from cloudperf.core import sftp_write_file, DictQuery, set_fail_on_exit, format_samples
+from cloudperf import metrics
+from cloudperf.scheduler import QuotaScheduler
+from cloudperf.sampling import geometric_points, interpolate, sample_stats
 
 
 session = boto3.session.Session()
@@ -43,8 +51,20 @@ userdata_script = """#!/bin/sh
 shutdown +120"""
 ssh_keyname = 'batch'
 ssh_user = 'ec2-user'
+ssh_port = 22
+# give the instance this many seconds after it's running before trying ssh
+ssh_connect_delay = 5
 # metal instances may need a lot of time to start
 ssh_get_conn_timeout = 30*60
+# the states of all launched instances are polled together by one thread,
+# with this many instance ids per describe_instances filter (the maximum is
+# 200) and results per page, every instance_poll_interval seconds for up to
+# instance_running_timeout seconds
+instance_poll_interval = 15
+instance_poll_batch = 200
+instance_running_timeout = 30*60
+# the states an instance doesn't get running from
+instance_failed_states = ('shutting-down', 'terminated', 'stopping', 'stopped')
 ssh_exec_timeout = 600
 ec2_specs = {'KeyName': ssh_keyname, 'SecurityGroups': ['tech-ssh'],
              'MaxCount': 1, 'MinCount': 1, 'Monitoring': {'Enabled': False},
@@ -55,6 +75,75 @@ ec2_specs = {'KeyName': ssh_keyname, 'SecurityGroups': ['tech-ssh'],
                                    {'ResourceType': 'volume',
                                     'Tags': [{'Value': 'cloudperf', 'Key': 'Application'}]}]}
 
+# error codes of throttled API requests
+throttling_codes = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException')
+# retry throttled requests this many times
+api_max_retries = 8
+# query the spot price history in this many regions at once
+spot_price_concurrency = 8
+# the pricing API is only available in these regions
+pricing_regions = ['us-east-1', 'ap-south-1']
+# split the pricing queries by the values of this product attribute and run
+# this many of them at once
+pricing_shard_attribute = 'location'
+pricing_concurrency = 8
+# the product attributes (with None) and the typecodes of the computed
+# columns we keep from the pricing API's products
+product_columns = {
+    'clockSpeed': None,
+    'gpu': None,
+    'gpuMemory': None,
+    'instanceFamily': None,
+    'instanceType': None,
+    'location': None,
+    'physicalProcessor': None,
+    'memory': 'd',
+    'price': 'd',
+    'vcpu': 'l',
+}
+
+# keep at most this many benchmarked instances running and use this share of
+# the account's vCPU quotas
+max_running_instances = 32
+quota_share = 1.0
+# EC2 running instance vCPU quota codes by instance class and market
+vcpu_quota_codes = {
+    'standard': {'on-demand': 'L-1216C47A', 'spot': 'L-34B43A08'},
+    'f': {'on-demand': 'L-74FC7D96', 'spot': 'L-88CF9481'},
+    'g': {'on-demand': 'L-DB2E81BA', 'spot': 'L-3819A6DF'},
+    'p': {'on-demand': 'L-417A185B', 'spot': 'L-7212CCBC'},
+    'x': {'on-demand': 'L-7295265B', 'spot': 'L-E3A00192'},
+    'dl': {'on-demand': 'L-6E869C2A', 'spot': 'L-85EED4F7'},
+    'inf': {'on-demand': 'L-1945791B', 'spot': 'L-B5D1601B'},
+    'trn': {'on-demand': 'L-2C3B7624', 'spot': 'L-6B0D517C'},
+    'high-memory': {'on-demand': 'L-43DA4232'},
+}
+# rough time estimates (seconds) for ordering the instances
+estimated_boot_time = 180
+estimated_metal_boot_time = 900
+estimated_run_overhead = 5
+# the phases of an instance's life other than running the benchmarks, used for
+# the runtime estimates from earlier runs' traces (the docker pulls run in
+# parallel with the init_script)
+overhead_phases = ('launch', 'wait_running', 'ssh_connect', 'docker_pull', 'settle', 'terminate')
+# let the instance settle down for this many seconds after the init_script and
+# each docker pull
+instance_settle_time = 20
+pull_settle_time = 10
+# try the docker pulls this many times
+docker_pull_tries = 4
+# the benchmarks are run by the agent on the instances, these files are
+# uploaded from the cloudperf package for it
+agent_files = ['agent.py', 'sampling.py']
+agent_python = 'python'
+agent_plan_keys = ('cmd', 'files', 'composefile', 'after_compose_up', 'after_compose_down', 'docker_opts',
+                   'timeout', 'cpus', 'cpu_sampling', 'cpu_tolerance', 'iterations', 'cv_threshold',
+                   'min_iterations', 'max_iterations')
+# wait this long for the next result before checking the connection
+agent_idle_timeout = ssh_exec_timeout
+agent_max_reconnects = 8
+agent_reconnect_timeout = 10*60
+
 instance_init_script = """#!/bin/sh
 sudo systemctl stop acpid chronyd crond ecs postfix
 sudo curl -L https://github.com/docker/compose/releases/download/1.23.2/docker-compose-`uname -s`-`uname -m` -o /usr/local/bin/docker-compose
@@ -62,6 +151,22 @@ sudo chmod +x /usr/local/bin/docker-compose
 """
 
 
+@cachetools.cached(cache={}, lock=threading.Lock())
+def aws_client(service, region):
+    # boto3 sessions are not thread safe, but the clients are, so create one
+    # client per service and region and share it between threads
+    return session.client(service, region_name=region)
+
+
+def backoff_delay(retry, base=0.5, cap=30):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(cap, base*2**retry))
+
+
+def is_throttled(e):
+    return isinstance(e, ClientError) and DictQuery(e.response).get(['Error', 'Code']) in throttling_codes
+
+
 def boto3_paginate(method, **kwargs):
     client = method.__self__
     paginator = client.get_paginator(method.__name__)
@@ -100,16 +205,15 @@ def aws_get_secret(name):
     return res['SecretString']
 
 
-def aws_get_cpu_arch(instance):
+def aws_get_cpu_arch(instances):
+    """Return the CPU architectures of the instances DataFrame's rows"""
     # XXX: maybe in the future Amazon will indicate the exact CPU architecture,
     # but until that...
-    physproc = DictQuery(instance).get(['product', 'attributes', 'physicalProcessor'], '').lower()
-    instance_type = DictQuery(instance).get(['product', 'attributes', 'instanceType'], '').lower()
-    if re.match('^a[0-9]+\.', instance_type) or re.search('aws\s+(graviton.*|)\s*processor', physproc):
-        # try to find arm instances
-        return 'arm64'
-
-    return 'x86_64'
+    physproc = instances['physicalProcessor'].astype(str).str.lower()
+    instance_type = instances['instanceType'].astype(str).str.lower()
+    # try to find arm instances
+    arm = instance_type.str.match(r'^a[0-9]+\.') | physproc.str.contains(r'aws\s+(?:graviton.*|)\s*processor')
+    return np.where(arm, 'arm64', 'x86_64')
 
 
 def aws_get_region():
@@ -219,6 +323,51 @@ def get_regions():
     return [region['RegionName'] for region in client.describe_regions()['Regions']]
 
 
+class ColumnBuilder(object):
+    """Collect rows into per-column arrays and build a DataFrame from them
+    at once. columns maps the column names to an array typecode for numeric
+    columns or None for (interned) strings."""
+
+    def __init__(self, columns):
+        self.columns = {name: array.array(typecode) if typecode else [] for name, typecode in columns.items()}
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()), []))
+
+    def append(self, row):
+        for name, column in self.columns.items():
+            value = row.get(name)
+            if isinstance(value, str):
+                value = sys.intern(value)
+            column.append(value)
+
+    def to_frame(self):
+        return pd.DataFrame({name: np.asarray(column) if isinstance(column, array.array) else column
+                             for name, column in self.columns.items()})
+
+
+def parse_ec2_product(data):
+    """Extract the needed attributes and the on-demand USD price from a
+    Pricing API product JSON
+
+    Returns:
+        dict of the product_columns or None if the product isn't usable
+    """
+    product = json.loads(data)
+    attributes = product['product']['attributes']
+    try:
+        on_demand = next(iter(product['terms']['OnDemand'].values()))
+        price = float(next(iter(on_demand['priceDimensions'].values()))['pricePerUnit']['USD'])
+    except Exception:
+        return None
+    if price == 0 or attributes['memory'] == 'NA' or attributes['vcpu'] == 'NA':
+        # skip these
+        return None
+    row = {name: attributes.get(name) for name, typecode in product_columns.items() if typecode is None}
+    row.update({'vcpu': int(attributes['vcpu']), 'memory': aws_parse_memory(attributes['memory']), 'price': price})
+    return row
+
+
 @cachetools.cached(cache={})
 def get_ec2_instances(**filter_opts):
     """Get AWS instances according to the given filter criteria
@@ -254,7 +403,8 @@ def get_ec2_instances(**filter_opts):
          'vcpu': '16'}
 
     Returns:
-        type: dict of AWS product descriptions
+        DataFrame of the product_columns of the matching products, which have
+        an on-demand price
 
     """
     filters = [{'Type': 'TERM_MATCH', 'Field': k, 'Value': v}
@@ -263,16 +413,56 @@ def get_ec2_instances(**filter_opts):
 
     # currently the pricing API is limited to some regions, so don't waste time
     # on trying to access it on others one by one
-    # regions = get_regions()
-    regions = ['us-east-1', 'ap-south-1']
-    for region in closest_regions(regions):
-        pricing = session.client('pricing', region_name=region)
-        instances = []
-        for data in boto3_paginate(pricing.get_products, ServiceCode='AmazonEC2', Filters=filters, MaxResults=100):
-            pd = json.loads(data)
-            instances.append(pd)
-        break
-    return instances
+    regions = closest_regions(pricing_regions)
+    shard_values = []
+    if pricing_shard_attribute not in filter_opts:
+        try:
+            shard_values = get_pricing_attribute_values(regions[0], pricing_shard_attribute)
+        except Exception:
+            logger.exception("Couldn't get {} values, fetching products serially".format(pricing_shard_attribute))
+    if not shard_values:
+        return to_categorical(get_pricing_products(regions[0], filters))
+
+    # split the query by the attribute's values and spread the shards between
+    # the pricing endpoints. The results are concatenated in the (sorted)
+    # order of the shards, so they don't depend on the completion order.
+    shards = [(regions[i % len(regions)],
+               filters + [{'Type': 'TERM_MATCH', 'Field': pricing_shard_attribute, 'Value': value}])
+              for i, value in enumerate(shard_values)]
+    with ThreadPoolExecutor(max_workers=pricing_concurrency) as executor:
+        results = executor.map(lambda shard: get_pricing_products(*shard), shards)
+        return to_categorical(pd.concat(list(results), ignore_index=True))
+
+
+def to_categorical(df):
+    return df.astype({name: 'category' for name, typecode in product_columns.items() if typecode is None})
+
+
+def get_pricing_attribute_values(region, attribute):
+    pricing = aws_client('pricing', region)
+    return sorted(v['Value'] for v in boto3_paginate(pricing.get_attribute_values, ServiceCode='AmazonEC2',
+                                                     AttributeName=attribute))
+
+
+def get_pricing_products(region, filters):
+    """Get the EC2 products matching filters from the region's pricing endpoint.
+    The products are parsed as they arrive, only keeping the product_columns.
+    """
+    pricing = aws_client('pricing', region)
+    for retry in range(api_max_retries):
+        builder = ColumnBuilder(product_columns)
+        try:
+            for data in boto3_paginate(pricing.get_products, ServiceCode='AmazonEC2', Filters=filters, MaxResults=100):
+                row = parse_ec2_product(data)
+                if row is not None:
+                    builder.append(row)
+            return builder.to_frame()
+        except ClientError as e:
+            if not is_throttled(e) or retry == api_max_retries-1:
+                raise
+            delay = backoff_delay(retry)
+            logger.info("Pricing request throttled in {}, retrying in {:.1f}s".format(region, delay))
+            time.sleep(delay)
 
 
 def get_ec2_defined_duration_prices():
@@ -326,6 +516,71 @@ def get_ec2_defined_duration_prices():
     return block_data
 
 
+def get_ec2_defined_duration_prices_df():
+    """Return the defined-duration prices as a table of region, instanceType
+    and a price_{n}h column for each duration"""
+    rows = [(region, instance_type, 'price_{}h'.format(duration), price)
+            for region, region_data in get_ec2_defined_duration_prices().items()
+            for instance_type, instance_data in region_data.items()
+            for duration, price in sorted(instance_data.items())]
+    df = pd.DataFrame(rows, columns=['region', 'instanceType', 'duration', 'price'])
+    if df.empty:
+        return df[['region', 'instanceType']]
+    # keep the columns in increasing duration order
+    durations = list(dict.fromkeys(sorted(df['duration'], key=lambda d: int(re.search('[0-9]+', d).group(0)))))
+    return df.pivot_table(index=['region', 'instanceType'], columns='duration', values='price',
+                          aggfunc='last')[durations].reset_index().rename_axis(columns=None)
+
+
+def get_region_spot_prices(region, instance_types):
+    """Get the current spot prices of instance_types in region
+
+    Returns:
+        list of (instance type, availability zone, price) tuples
+    """
+    ec2 = aws_client('ec2', region)
+    for retry in range(api_max_retries):
+        try:
+            return [(data['InstanceType'], data['AvailabilityZone'], float(data['SpotPrice']))
+                    for data in boto3_paginate(ec2.describe_spot_price_history, InstanceTypes=instance_types,
+                                               MaxResults=100, ProductDescriptions=['Linux/UNIX (Amazon VPC)'],
+                                               StartTime=datetime.now())]
+        except ClientError as e:
+            if not is_throttled(e) or retry == api_max_retries-1:
+                raise
+            delay = backoff_delay(retry)
+            logger.info("Spot price history request throttled in {}, retrying in {:.1f}s".format(region, delay))
+            time.sleep(delay)
+
+
+def iter_spot_prices(instance_types, regions):
+    """Query the spot prices in regions concurrently and yield
+    (region, get_region_spot_prices results) as each region finishes"""
+    with ThreadPoolExecutor(max_workers=spot_price_concurrency) as executor:
+        futures = {executor.submit(get_region_spot_prices, region, instance_types): region for region in regions}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+# conserve memory
+keep_cols = [
+    "clockSpeed",
+    "cpu_arch",
+    "gpuMemory",
+    "instanceType",
+    "instanceFamily",
+    "location",
+    "memory",
+    "physicalProcessor",
+    "price",
+    "region",
+    "spot",
+    "spot-az",
+    "vcpu",
+    "gpu",
+]
+
+
 def get_ec2_prices(fail_on_missing_regions=False, **filter_opts):
     """Get AWS instance prices according to the given filter criteria
 
@@ -337,35 +592,22 @@ def get_ec2_prices(fail_on_missing_regions=False, **filter_opts):
 
     """
     from cloudperf.providers.aws import region_to_location, location_to_region
-    prices = []
-    params = {}
-
-    missing_regions = set()
-    for data in get_ec2_instances(**filter_opts):
-        try:
-            instance_type = data['product']['attributes']['instanceType']
-            price = float(list(list(data['terms']['OnDemand'].values())[
-                          0]['priceDimensions'].values())[0]['pricePerUnit']['USD'])
-        except Exception:
-            continue
-        if price == 0:
-            continue
-        if data['product']['attributes']['memory'] == 'NA' or \
-                data['product']['attributes']['vcpu'] == 'NA':
-            # skip these
-            continue
-        vcpu = int(data['product']['attributes']['vcpu'])
-        memory = aws_parse_memory(data['product']['attributes']['memory'])
-        region = location_to_region(data['product']['attributes']['location'])
-        if not region:
-            missing_regions.add(data['product']['attributes']['location'])
-        params[instance_type] = data['product']['attributes']
-        params[instance_type].update({'vcpu': vcpu, 'memory': memory, 'region': region,
-                                      'cpu_arch': aws_get_cpu_arch(data),
-                                      'date': datetime.now()})
-        d = {'price': price, 'spot': False, 'spot-az': None}
-        d.update(params[instance_type])
-        prices.append(d)
+    instances = get_ec2_instances(**filter_opts)
+    if instances.empty:
+        # we couldn't find any matching instances
+        return pd.DataFrame(columns=keep_cols)
+
+    regions = {location: location_to_region(location) for location in instances['location'].dropna().unique()}
+    missing_regions = {location for location, region in regions.items() if not region}
+    prices = instances.astype({'location': str}).assign(
+        region=instances['location'].astype(str).map(regions),
+        cpu_arch=aws_get_cpu_arch(instances),
+        date=datetime.now(),
+        spot=False)
+    prices['spot-az'] = None
+    # the last product's attributes are used for the spot instances
+    attributes = prices.drop_duplicates('instanceType', keep='last').drop(
+        columns=['price', 'region', 'location', 'spot', 'spot-az'])
 
     if fail_on_missing_regions and missing_regions:
         print("The following regions are missing from botocore's endpoints.json and from "
@@ -373,45 +615,116 @@ def get_ec2_prices(fail_on_missing_regions=False, **filter_opts):
         print(*missing_regions, sep='\n')
         sys.exit(1)
 
-    if not prices:
-        # we couldn't find any matching instances
-        return prices
+    # collect the spot prices into a narrow table and join the instance
+    # attributes to it
+    spot = pd.concat([pd.DataFrame(spot_prices, columns=['instanceType', 'spot-az', 'price']).assign(region=region)
+                      for region, spot_prices in iter_spot_prices(list(attributes['instanceType']), get_regions())],
+                     ignore_index=True)
+    # the regions come in the order their queries finish and the price
+    # history in no particular order, sort them for a reproducible output
+    spot = spot.merge(attributes, on='instanceType').sort_values(['region', 'instanceType', 'spot-az'], kind='stable',
+                                                                 ignore_index=True)
+    spot['location'] = spot['region'].map({region: region_to_location(region) for region in spot['region'].unique()})
+    spot['spot'] = True
 
     # get actual defined-duration spot prices from the web, until the pricing
     # API supports these...
-    block_prices = get_ec2_defined_duration_prices()
-
-    for region in get_regions():
-        ec2 = session.client('ec2', region_name=region)
-        for data in boto3_paginate(ec2.describe_spot_price_history, InstanceTypes=list(params.keys()),
-                                   MaxResults=100, ProductDescriptions=['Linux/UNIX (Amazon VPC)'], StartTime=datetime.now()):
-            instance_type = data['InstanceType']
-            d = copy.deepcopy(params[instance_type])
-            d.update({'price': float(data['SpotPrice']), 'spot': True, 'spot-az': data['AvailabilityZone'], 'region': region})
-            d.update({'location': region_to_location(region)})
-            for duration, price in DictQuery(block_prices).get([region, instance_type], {}).items():
-                # add spot blocked duration prices, if any
-                d.update({f'price_{duration}h': price})
-            prices.append(d)
-
-    # conserve memory
-    keep_cols = [
-        "clockSpeed",
-        "cpu_arch",
-        "gpuMemory",
-        "instanceType",
-        "instanceFamily",
-        "location",
-        "memory",
-        "physicalProcessor",
-        "price",
-        "region",
-        "spot",
-        "spot-az",
-        "vcpu",
-        "gpu",
-    ]
-    return pd.DataFrame.from_dict(prices)[keep_cols]
+    block_prices = get_ec2_defined_duration_prices_df()
+    if not block_prices.empty:
+        # add spot blocked duration prices, if any
+        spot = spot.merge(block_prices, on=['region', 'instanceType'], how='left')
+
+    cols = keep_cols + list(block_prices.columns.drop(['region', 'instanceType']))
+    return pd.concat([prices, spot], ignore_index=True, sort=False)[cols]
+
+
+class InstancePoller(object):
+    """Waits for instances to get running, like the instance_running waiter,
+    but polls the states of all the waited instances with one paginated
+    describe_instances call per instance_poll_interval, so the API calls don't
+    grow with the number of instances benchmarked at once. The polling thread
+    runs while there are instances to wait for."""
+
+    def __init__(self, ec2):
+        self.ec2 = ec2
+        self.lock = threading.Lock()
+        # instance id -> (Future, deadline)
+        self.pending = {}
+        self.thread = None
+
+    def wait_running(self, instance_id, timeout=None):
+        """Return a Future of the instance's description, which is set when
+        it's running, or fails if it gets into a failed state or isn't running
+        in timeout seconds"""
+        future = Future()
+        deadline = time.time() + (instance_running_timeout if timeout is None else timeout)
+        with self.lock:
+            self.pending[instance_id] = (future, deadline)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='instance_poller', daemon=True)
+                self.thread.start()
+        return future
+
+    def describe(self, instance_ids):
+        """Yield the descriptions of the instances"""
+        for i in range(0, len(instance_ids), instance_poll_batch):
+            kwargs = {'Filters': [{'Name': 'instance-id', 'Values': instance_ids[i:i+instance_poll_batch]}],
+                      'MaxResults': instance_poll_batch}
+            while True:
+                res = self.ec2.describe_instances(**kwargs)
+                for reservation in res['Reservations']:
+                    for instance in reservation['Instances']:
+                        yield instance
+                if not res.get('NextToken'):
+                    break
+                kwargs['NextToken'] = res['NextToken']
+
+    def poll(self):
+        with self.lock:
+            pending = dict(self.pending)
+        states = {}
+        try:
+            for instance in self.describe(list(pending)):
+                states[instance['InstanceId']] = instance
+        except Exception as e:
+            # the ones we've seen are still valid, retry the rest next time
+            if is_throttled(e):
+                logger.info("Instance state polling throttled: {}".format(e))
+            else:
+                logger.exception("Couldn't poll the instance states")
+        now = time.time()
+        done = {}
+        for instance_id, (future, deadline) in pending.items():
+            instance = states.get(instance_id)
+            state = DictQuery(instance).get(['State', 'Name']) if instance else None
+            if state == 'running':
+                done[instance_id] = (future.set_result, instance)
+            elif state in instance_failed_states:
+                done[instance_id] = (future.set_exception,
+                                     RuntimeError('Instance {} is {}'.format(instance_id, state)))
+            elif now > deadline:
+                done[instance_id] = (future.set_exception,
+                                     RuntimeError('Instance {} is not running in time, state: {}'.format(
+                                         instance_id, state)))
+        with self.lock:
+            for instance_id in done:
+                del self.pending[instance_id]
+        for set_future, value in done.values():
+            set_future(value)
+
+    def run(self):
+        while True:
+            time.sleep(instance_poll_interval)
+            self.poll()
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+
+
+@cachetools.cached(cache={}, lock=threading.Lock())
+def instance_poller(region):
+    return InstancePoller(aws_client('ec2', region))
 
 
 def get_ssh_connection(instance, user, pkey, timeout):
@@ -420,7 +733,8 @@ def get_ssh_connection(instance, user, pkey, timeout):
     start = time.time()
     while start+timeout > time.time():
         try:
-            ssh.connect(instance['PrivateIpAddress'], username=user, pkey=pkey, timeout=10, auth_timeout=10)
+            ssh.connect(instance['PrivateIpAddress'], port=ssh_port, username=user, pkey=pkey, timeout=10,
+                        auth_timeout=10)
             break
         except Exception as e:
             logger.info("Couldn't connect: {}, retrying for {:.0f}s".format(e, start+timeout-time.time()))
@@ -430,6 +744,139 @@ def get_ssh_connection(instance, user, pkey, timeout):
     return ssh
 
 
+def start_docker_pulls(ssh, images):
+    """Start pulling images in parallel, each on its own channel"""
+    pulls = {}
+    for image in images:
+        logger.info("Docker pull {}".format(image))
+        # wait some time after the pull, so the disk writes settle down
+        pulls[image] = ssh.exec_command("docker pull {} && sync && sleep {}".format(image, pull_settle_time),
+                                        timeout=ssh_exec_timeout)
+    return pulls
+
+
+def wait_docker_pulls(ssh, pulls):
+    """Wait for the pulls started with start_docker_pulls, retry the failed
+    ones and return the set of successfully pulled images"""
+    pulled = set()
+    for i in range(docker_pull_tries):
+        failed = set()
+        for image, (stdin, stdout, stderr) in pulls.items():
+            if stdout.channel.recv_exit_status() == 0:
+                pulled.add(image)
+            else:
+                logger.info("Docker pull {} failed, try #{}: {}, {}".format(image, i, stdout.read(), stderr.read()))
+                failed.add(image)
+        if not failed:
+            break
+        # only retry if we'll wait for it, a pull left running would disturb
+        # the benchmarks
+        if i < docker_pull_tries-1:
+            time.sleep(5)
+            pulls = start_docker_pulls(ssh, failed)
+    else:
+        logger.error("Couldn't pull docker images {}".format(', '.join(sorted(failed))))
+    return pulled
+
+
+def benchmark_record(instance_type, name, numcpu, score, samples, interpolated, date):
+    stats = sample_stats(samples)
+    return {'instanceType': instance_type, 'benchmark_id': name,
+            'benchmark_cpus': numcpu, 'benchmark_score': score, 'benchmark_interpolated': interpolated,
+            'benchmark_samples': format_samples(samples), 'benchmark_n': stats['n'], 'benchmark_stddev': stats['stddev'],
+            'benchmark_min': stats['min'], 'benchmark_max': stats['max'], 'date': date}
+
+
+def agent_plan(instance, benchmarks_to_run, pulled):
+    """Return the benchmark plan for the agent running on instance"""
+    plan = []
+    for name, bench_data in benchmarks_to_run.items():
+        docker_img = bench_data['images'].get(instance.cpu_arch, None)
+        if not docker_img:
+            logger.error("Couldn't find docker image for {}/{}".format(name, instance.cpu_arch))
+            continue
+        if docker_img not in pulled:
+            logger.error("Docker image {} isn't available, skipping {}".format(docker_img, name))
+            continue
+        bench = {k: bench_data[k] for k in agent_plan_keys if k in bench_data}
+        aggr_f = bench_data.get('score_aggregation', max)
+        bench.update({'id': name, 'image': docker_img, 'maxcpu': instance.vcpu,
+                      'score_aggregation': getattr(aggr_f, '__name__', None)})
+        plan.append(bench)
+    return {'benchmarks': plan}
+
+
+def start_agent(ssh, sftp, plan):
+    """Upload the agent with the plan and start it in the background, so it
+    survives a dropped connection. Returns the agent's pid."""
+    for name in agent_files:
+        sftp_write_file(sftp, name, pkgutil.get_data('cloudperf', name), 0o644)
+    sftp_write_file(sftp, 'plan.json', json.dumps(plan), 0o644)
+    stdin, stdout, stderr = ssh.exec_command(
+        "rm -f results.jsonl; nohup {} agent.py plan.json results.jsonl > agent.log 2>&1 < /dev/null & echo $!".format(
+            agent_python), timeout=ssh_exec_timeout)
+    return int(stdout.read())
+
+
+def read_agent_results(ec2_inst, ssh, pkey, pid):
+    """Stream the agent's results until it's done, reconnecting if the ssh
+    connection drops. Yields the result records."""
+    seen = 0
+    reconnects = 0
+    conn = ssh
+    try:
+        while True:
+            try:
+                # tail exits when the agent does, so we get an EOF if it dies
+                stdin, stdout, stderr = conn.exec_command(
+                    "tail --pid={} -n +{} -F results.jsonl 2>/dev/null".format(pid, seen+1))
+                channel = stdout.channel
+                channel.settimeout(agent_idle_timeout)
+                buf = b''
+                while True:
+                    try:
+                        data = channel.recv(65536)
+                    except socket.timeout:
+                        transport = conn.get_transport()
+                        if transport is not None and transport.is_active():
+                            # a long running benchmark, keep waiting
+                            continue
+                        raise
+                    if not data:
+                        break
+                    # only the complete lines are records
+                    lines = (buf + data).split(b'\n')
+                    buf = lines.pop()
+                    for line in lines:
+                        seen += 1
+                        record = json.loads(line)
+                        if record['type'] == 'done':
+                            channel.close()
+                            return
+                        yield record
+                channel.close()
+                stdin, stdout, stderr = conn.exec_command("tail -20 agent.log", timeout=ssh_exec_timeout)
+                logger.error("Agent exited before finishing: {}".format(stdout.read()))
+                return
+            except socket.timeout:
+                logger.info("Connection to the agent timed out")
+            except (paramiko.SSHException, socket.error, EOFError) as e:
+                logger.info("Lost connection to the agent: {}".format(e))
+            reconnects += 1
+            if reconnects > agent_max_reconnects:
+                logger.error("Couldn't reconnect to the agent, giving up")
+                return
+            conn.close()
+            conn = get_ssh_connection(ec2_inst, ssh_user, pkey, agent_reconnect_timeout)
+            if conn is None:
+                logger.error("Couldn't reconnect to the agent")
+                return
+    finally:
+        # the caller closes its own connection
+        if conn is not None and conn is not ssh:
+            conn.close()
+
+
 def log_exception(function):
     @functools.wraps(function)
     def wrapper(*args, **kwargs):
@@ -442,9 +889,20 @@ def log_exception(function):
 
 
 @log_exception
-def run_benchmarks(args):
+def run_benchmarks(args, lease=None):
+    instance = args[1]
+    # the spans of this thread are tagged with these
+    metrics.set_tags(instanceType=instance.instanceType, arch=instance.cpu_arch, spot=True)
+    with metrics.span('instance') as span:
+        res = benchmark_instance(args, lease)
+        if res is None:
+            span.tag(outcome='failed')
+    return res
+
+
+def benchmark_instance(args, lease=None):
     threading.current_thread().name = 'run_bench'
-    ami, instance, tags, benchmarks_to_run = args
+    ami, instance, tags, benchmarks_to_run, journal = args
     specs = copy.deepcopy(ec2_specs)
     # extend tagspecs with user specified tags
     tagspecs = [{'Key': k, 'Value': v} for k, v in tags]
@@ -474,17 +932,33 @@ def run_benchmarks(args):
     create_specs = spotspecs
     retcount = 0
     ec2_inst = None
-    ec2 = session.client('ec2', region_name=aws_get_region())
+    ec2 = aws_client('ec2', aws_get_region())
+    launch_start = time.time()
+    attempts = 0
+    error = None
     while retcount < 16:
+        attempts += 1
+        if lease:
+            # move our quota reservation if we've switched to on-demand and
+            # wait if the requests are throttled
+            lease.switch(vcpu_quota_pool(instance.instanceType, spot=create_specs is spotspecs))
+            lease.wait()
         try:
             ec2_inst = ec2.run_instances(**create_specs)['Instances'][0]
+            if lease:
+                lease.succeeded()
             break
         except ClientError as e:
+            error = e.response['Error']['Code']
             # retry on request limit exceeded
             if e.response['Error']['Code'] == 'RequestLimitExceeded':
                 logger.info("Request limit for {}: {}, retry #{}".format(instance.instanceType,
                                                                            e.response['Error']['Message'], retcount))
-                time.sleep(1.2**retcount)
+                if lease:
+                    # back off globally
+                    lease.throttled()
+                else:
+                    time.sleep(1.2**retcount)
                 retcount += 1
                 continue
 
@@ -564,31 +1038,34 @@ def run_benchmarks(args):
             time.sleep(1.2**retcount)
             retcount += 1
 
+    metrics.tag(spot=create_specs is spotspecs)
+    metrics.record('launch', launch_start, time.time(), retries=attempts-1, error=error,
+                   outcome='ok' if ec2_inst else 'failed')
     if not ec2_inst:
         return None
 
     instance_id = ec2_inst['InstanceId']
     threading.current_thread().name = instance_id
+    metrics.tag(instance_id=instance_id)
 
     logger.info(
         "Waiting for instance {} to be ready. AMI: {}".format(instance.instanceType, ami))
     # wait for the instance
-    try:
-        waiter = ec2.get_waiter('instance_running')
-        waiter.wait(InstanceIds=[instance_id], WaiterConfig={
-            # wait for up to 30 minutes
-            'Delay': 15,
-            'MaxAttempts': 120
-            })
-    except Exception:
-        logger.exception(
-            'Waiter failed for {}'.format(instance.instanceType))
-
-    # give 5 secs before trying ssh
-    time.sleep(5)
-    pkey = paramiko.RSAKey.from_private_key(
-        StringIO(aws_get_secret('ssh_keys/{}'.format(ssh_keyname))))
-    ssh = get_ssh_connection(ec2_inst, ssh_user, pkey, ssh_get_conn_timeout)
+    with metrics.span('wait_running') as span:
+        try:
+            instance_poller(aws_get_region()).wait_running(instance_id).result()
+        except Exception:
+            span.tag(outcome='error')
+            logger.exception(
+                'Waiting for running failed for {}'.format(instance.instanceType))
+
+    with metrics.span('ssh_connect') as span:
+        time.sleep(ssh_connect_delay)
+        pkey = paramiko.RSAKey.from_private_key(
+            StringIO(aws_get_secret('ssh_keys/{}'.format(ssh_keyname))))
+        ssh = get_ssh_connection(ec2_inst, ssh_user, pkey, ssh_get_conn_timeout)
+        if ssh is None:
+            span.tag(outcome='failed')
     if ssh is None:
         logger.error("Couldn't open an ssh connection, terminating instance")
         ec2.terminate_instances(InstanceIds=[instance_id])
@@ -596,7 +1073,15 @@ def run_benchmarks(args):
 
     sftp = ssh.open_sftp()
 
+    # pull the images of all benchmarks in the background, while the instance
+    # initializes and settles down
+    images = {bench_data['images'][instance.cpu_arch] for bench_data in benchmarks_to_run.values()
+              if instance.cpu_arch in bench_data['images']}
+    pull_start = time.time()
+    pulls = start_docker_pulls(ssh, images)
+
     # write init_script
+    init_start = time.time()
     for i in range(4):
         try:
             sftp_write_file(sftp, 'init_script', instance_init_script)
@@ -612,128 +1097,102 @@ def run_benchmarks(args):
             break
         time.sleep(5)
     else:
+        metrics.record('init_script', init_start, time.time(), retries=i, outcome='failed')
         logger.error("Couldn't execute init_script: {}, {}".format(
             stdout.read(), stderr.read()))
         ec2.terminate_instances(InstanceIds=[instance_id])
         return None
 
-    # give some more time for the machine to be ready and to settle down
-    time.sleep(20)
+    init_done = time.time()
+    metrics.record('init_script', init_start, init_done, retries=i)
+    pulled = wait_docker_pulls(ssh, pulls)
+    metrics.record('docker_pull', pull_start, time.time(), images=len(images), failed=len(images - pulled),
+                   outcome='ok' if pulled == images else 'failed')
+    # give some more time for the machine to be ready and to settle down, but
+    # count the time we've spent with waiting for the pulls
+    with metrics.span('settle'):
+        time.sleep(max(0, init_done+instance_settle_time-time.time()))
 
     results = []
+    run_start = bench_start = time.time()
+    run_outcome = 'ok'
     try:
-        for name, bench_data in benchmarks_to_run.items():
-            threading.current_thread().name = '{}/{}'.format(instance_id, name)
-            docker_img = bench_data['images'].get(instance.cpu_arch, None)
-            if not docker_img:
-                logger.error("Couldn't find docker image for {}/{}".format(name, instance.cpu_arch))
+        plan = agent_plan(instance, benchmarks_to_run, pulled)
+        pid = start_agent(ssh, sftp, plan)
+        scores = collections.defaultdict(dict)
+        for record in read_agent_results(ec2_inst, ssh, pkey, pid):
+            if record['type'] == 'error':
+                logger.error("Error while running {}: {}".format(record['benchmark_id'], record['error']))
+                metrics.record('benchmark', bench_start, time.time(), benchmark_id=record['benchmark_id'],
+                               outcome='error')
+                bench_start = time.time()
                 continue
-            # write files for the benchmark
-            for name, contents in bench_data['images'].get('files', {}):
-                sftp_write_file(sftp, name, contents)
-
-            # docker pull and wait some time
-            for i in range(4):
-                logger.info("Docker pull, try #{}".format(i))
-                stdin, stdout, stderr = ssh.exec_command("docker pull {}; sync; sleep 10".format(docker_img), timeout=ssh_exec_timeout)
-                if stdout.channel.recv_exit_status() == 0:
-                    break
-                time.sleep(5)
-            else:
-                logger.error("Couldn't pull docker image {}, {}".format(
-                    stdout.read(), stderr.read()))
+            if record['type'] == 'complete':
+                if journal:
+                    journal.complete(instance.instanceType, record['benchmark_id'])
+                metrics.record('benchmark', bench_start, time.time(), benchmark_id=record['benchmark_id'])
+                bench_start = time.time()
                 continue
-
-            if 'composefile' in bench_data:
-                sftp_write_file(sftp, 'docker-compose.yml', bench_data['composefile'], 0o644)
-                # start docker compose
-                stdin, stdout, stderr = ssh.exec_command("docker-compose up -d", timeout=ssh_exec_timeout)
-                if stdout.channel.recv_exit_status() != 0:
-                    logger.error("Couldn't start docker compose {}, {}".format(
-                        stdout.read(), stderr.read()))
-                    continue
-
-                if 'after_compose_up' in bench_data:
-                    sftp_write_file(sftp, 'after_compose_up', bench_data['after_compose_up'])
-                    stdin, stdout, stderr = ssh.exec_command("./after_compose_up", timeout=ssh_exec_timeout)
-                    if stdout.channel.recv_exit_status() != 0:
-                        logger.error("Couldn't start after_compose_up script {}, {}".format(
-                            stdout.read(), stderr.read()))
-                        continue
-
-            if 'cpus' in bench_data and bench_data['cpus']:
-                cpulist = bench_data['cpus']
-            else:
-                cpulist = range(1, instance.vcpu+1)
-
-            # default options if missing
-            docker_opts = bench_data.get('docker_opts', '--network none')
-            for i in cpulist:
-                ssh.exec_command("sync", timeout=ssh_exec_timeout)
-                dcmd = bench_data['cmd'].format(numcpu=i)
-                if 'timeout' in bench_data:
-                    timeout_cmd = 'timeout -k {} {} '.format(bench_data['timeout']+5, bench_data['timeout'])
-                else:
-                    timeout_cmd = ''
-                cmd = '{}docker run --rm {} {} {}'.format(timeout_cmd, docker_opts, docker_img, dcmd)
-                scores = []
-                for it in range(bench_data.get('iterations', 3)):
-                    logger.info("Running command: {}, iter: #{}".format(cmd, it))
-                    stdin, stdout, stderr = ssh.exec_command(cmd, timeout=ssh_exec_timeout)
-                    ec = stdout.channel.recv_exit_status()
-                    stdo = stdout.read()
-                    stdrr = stderr.read()
-                    if ec == 0:
-                        try:
-                            scores.append(float(stdo))
-                        except Exception:
-                            logger.info(
-                                "Couldn't parse output: {}".format(stdo))
-                            scores.append(None)
-                    else:
-                        logger.info("Non-zero exit code {}, {}, {}".format(ec, stdo, stdrr))
-                aggr_f = bench_data.get('score_aggregation', max)
+            name = record['benchmark_id']
+            numcpu = record['benchmark_cpus']
+            if record['type'] == 'sample':
+                # compute the score here, the agent only knows the aggregation
+                # functions by name
+                aggr_f = benchmarks_to_run[name].get('score_aggregation', max)
                 try:
-                    score = aggr_f(scores)
+                    score = None if record['unparseable'] else aggr_f([s for s in record['samples'] if s is not None])
                 except Exception:
                     score = None
-                results.append({'instanceType': instance.instanceType,
-                                'benchmark_cpus': i, 'benchmark_score': score, 'benchmark_id': name,
-                                'date': datetime.now()})
-            if 'composefile' in bench_data:
-                stdin, stdout, stderr = ssh.exec_command("docker-compose down -v", timeout=ssh_exec_timeout)
-                if stdout.channel.recv_exit_status() != 0:
-                    logger.error("Couldn't stop docker compose: {}, {}".format(
-                        stdout.read(), stderr.read()))
-                    continue
-                if 'after_compose_down' in bench_data:
-                    sftp_write_file(sftp, 'after_compose_down', bench_data['after_compose_down'])
-                    stdin, stdout, stderr = ssh.exec_command("./after_compose_down", timeout=ssh_exec_timeout)
-                    if stdout.channel.recv_exit_status() != 0:
-                        logger.error("Couldn't start after_compose_down script: {}, {}".format(
-                            stdout.read(), stderr.read()))
-                        continue
+                scores[name][numcpu] = score
+                samples = record['samples']
+            else:
+                a, b = record['between']
+                score = interpolate(numcpu, a, scores[name].get(a), b, scores[name].get(b))
+                samples = []
+            results.append(benchmark_record(instance.instanceType, name, numcpu, score, samples,
+                                            record['type'] == 'interpolated', datetime.fromtimestamp(record['time'])))
+            if journal:
+                journal.append(results[-1])
     except Exception:
+        run_outcome = 'error'
         logger.exception("Error while executing benchmarks")
+    finally:
+        ssh.close()
+    metrics.record('run', run_start, time.time(), benchmarks=len(benchmarks_to_run), results=len(results),
+                   outcome=run_outcome)
 
     logger.info("Finished with instance, terminating")
-    ec2.terminate_instances(InstanceIds=[instance_id])
+    with metrics.span('terminate'):
+        ec2.terminate_instances(InstanceIds=[instance_id])
     if results:
         return pd.DataFrame.from_dict(results)
     else:
         return None
 
 
-def get_benchmarks_to_run(instance, perf_df, expire):
+def staleness_index(perf_df, expire, now=None):
+    """Return the last run date of each (instanceType, benchmark_id) in
+    perf_df and whether it has expired (it's at least expire seconds old)"""
+    if now is None:
+        now = datetime.now()
+    if perf_df is None or perf_df.empty:
+        index = pd.MultiIndex.from_tuples([], names=['instanceType', 'benchmark_id'])
+        return pd.DataFrame({'date': pd.Series(dtype='datetime64[ns]'), 'expired': pd.Series(dtype=bool)},
+                            index=index)
+    staleness = perf_df.groupby(['instanceType', 'benchmark_id'], observed=True)['date'].max().to_frame()
+    staleness['expired'] = (pd.Timestamp(now) - staleness['date']).dt.total_seconds() >= (expire or 0)
+    return staleness
+
+
+def get_benchmarks_to_run(instance, staleness):
     my_benchmarks = copy.deepcopy(benchmarks)
-    # filter the incoming perf data only to our instance type
-    perf_df = perf_df[perf_df['instanceType'] == instance.instanceType][['instanceType', 'benchmark_id', 'date']].drop_duplicates()
-    for idx, row in perf_df.iterrows():
-        if (datetime.now() - row.date).seconds >= expire:
-            # leave the benchmark if it's not yet expired ...
-            continue
-        # ... and drop, if it is
-        my_benchmarks.pop(row.benchmark_id, None)
+    if instance.instanceType not in staleness.index.get_level_values('instanceType'):
+        return my_benchmarks
+    # drop the benchmarks which have been run on this instance type and not
+    # yet expired
+    runs = staleness.xs(instance.instanceType, level='instanceType')
+    for benchmark_id in runs.index[~runs['expired']]:
+        my_benchmarks.pop(benchmark_id, None)
 
     return my_benchmarks
 
@@ -745,32 +1204,208 @@ def is_blacklisted(instance):
     return False
 
 
-def get_ec2_performance(prices_df, perf_df=None, update=None, expire=None, tags=[], **filter_opts):
+def vcpu_quota_class(instance_type):
+    family = re.match('[a-z]*', instance_type).group(0)
+    if instance_type.startswith('u-'):
+        return 'high-memory'
+    if family in ('inf', 'dl', 'trn'):
+        return family
+    if family[:1] in ('f', 'g', 'p', 'x'):
+        return family[:1]
+    if family == 'vt':
+        return 'g'
+    return 'standard'
+
+
+def vcpu_quota_pool(instance_type, spot=True):
+    return (vcpu_quota_class(instance_type), 'spot' if spot else 'on-demand')
+
+
+@cachetools.cached(cache={})
+def get_vcpu_quotas():
+    """Return the account's running instance vCPU quotas, keyed by
+    vcpu_quota_pool. Missing (unknown) quotas are not limited."""
+    sq = aws_client('service-quotas', aws_get_region())
+    quotas = {}
+    for quota_class, codes in vcpu_quota_codes.items():
+        for market, code in codes.items():
+            try:
+                quotas[(quota_class, market)] = int(sq.get_service_quota(ServiceCode='ec2', QuotaCode=code)['Quota']['Value'])
+            except Exception as e:
+                logger.info("Couldn't get the {} {} vCPU quota: {}".format(market, quota_class, e))
+    return quotas
+
+
+def estimate_benchmark_runtime(vcpu, bench_data):
+    """Estimate a benchmark's runtime on vcpu CPUs from its definition. The
+    runs repeated until stable are counted with max_iterations, so it's an
+    upper estimate for those. Adaptive CPU sweeps are counted with the
+    geometric points and one bisection of each interval between them, the
+    bisections of a curve which isn't piecewise linear add more."""
+    if bench_data.get('cpus'):
+        points = len(bench_data['cpus'])
+    elif bench_data.get('cpu_sampling') == 'adaptive':
+        geometric = geometric_points(vcpu)
+        points = len(geometric) + sum(1 for a, b in zip(geometric, geometric[1:]) if b-a >= 2)
+    else:
+        points = vcpu
+    if bench_data.get('cv_threshold'):
+        iterations = bench_data.get('max_iterations', 10)
+    else:
+        iterations = bench_data.get('iterations', 3)
+    return points * iterations * (bench_data.get('timeout', 60) + estimated_run_overhead)
+
+
+def is_metal(instance_type):
+    return instance_type.endswith('.metal')
+
+
+class RuntimeModel(object):
+    """Runtime estimates calibrated by the phase timings of earlier runs (the
+    span records of their trace files, see cloudperf.metrics).
+
+    The overhead of an instance is the sum of the median overhead phases of
+    the (metal or non-metal) instances. A benchmark takes its median time on
+    the same instance type, or if it hasn't run there, its static estimate
+    scaled by the median ratio of its measured and static estimates on the
+    other instance types (vcpus maps them to their vCPUs)."""
+
+    def __init__(self, spans=(), vcpus=None):
+        self.vcpus = vcpus or {}
+        self.phases = collections.defaultdict(list)
+        self.benchmarks = collections.defaultdict(list)
+        for span in spans:
+            tags = span.get('tags', {})
+            if tags.get('outcome') != 'ok' or 'instanceType' not in tags:
+                continue
+            if span['span'] in overhead_phases:
+                self.phases[(span['span'], is_metal(tags['instanceType']))].append(span['duration'])
+            elif span['span'] == 'benchmark':
+                self.benchmarks[tags['benchmark_id']].append((tags['instanceType'], span['duration']))
+
+    def overhead(self, instance_type):
+        times = [self.phases.get((phase, is_metal(instance_type))) for phase in overhead_phases]
+        if not all(times):
+            return None
+        return sum(float(np.median(t)) for t in times)
+
+    def benchmark(self, instance, name, bench_data):
+        estimate = estimate_benchmark_runtime(instance.vcpu, bench_data)
+        runs = self.benchmarks.get(name, [])
+        same = [duration for instance_type, duration in runs if instance_type == instance.instanceType]
+        if same:
+            return float(np.median(same))
+        ratios = [duration / estimate_benchmark_runtime(self.vcpus[instance_type], bench_data)
+                  for instance_type, duration in runs if instance_type in self.vcpus]
+        if ratios:
+            return estimate * float(np.median(ratios))
+        return estimate
+
+
+def estimate_runtime(instance, benchmarks_to_run, model=None):
+    """Give a rough estimate of an instance's benchmarking time in seconds,
+    refined by model (a RuntimeModel) if given"""
+    runtime = model.overhead(instance.instanceType) if model else None
+    if runtime is None:
+        runtime = estimated_metal_boot_time if is_metal(instance.instanceType) else estimated_boot_time
+    for name, bench_data in benchmarks_to_run.items():
+        if model:
+            runtime += model.benchmark(instance, name, bench_data)
+        else:
+            runtime += estimate_benchmark_runtime(instance.vcpu, bench_data)
+    return runtime
+
+
+def ec2_benchmark_queue(prices_df, perf_df=None, update=None, expire=None, journal=None):
+    """Yield (instance, benchmarks to run, age) of each instance type which has
+    benchmarks to run, age is the time (seconds) since its last benchmark"""
     # drop spot instances
     prices_df = prices_df.drop(prices_df[prices_df.spot == True].index)
     # remove duplicate instances, so we'll have a list of all on-demand instances
     prices_df = prices_df.drop_duplicates(subset='instanceType')
 
-    bench_args = []
+    now = datetime.now()
+    staleness = staleness_index(perf_df, expire, now)
+    last_run = staleness.groupby(level='instanceType', observed=True)['date'].max()
+    # the benchmarks finished by an earlier, interrupted run
+    completed = journal.completed() if journal else set()
     for instance in prices_df.itertuples():
         if is_blacklisted(instance.instanceType):
             logger.info("Skipping blacklisted instance: {}".format(instance.instanceType))
             continue
-        ami = aws_get_latest_ami(arch=instance.cpu_arch)
         if perf_df is not None and update:
-            benchmarks_to_run = get_benchmarks_to_run(instance, perf_df, expire)
+            benchmarks_to_run = get_benchmarks_to_run(instance, staleness)
         else:
             benchmarks_to_run = benchmarks
+        benchmarks_to_run = {name: bench_data for name, bench_data in benchmarks_to_run.items()
+                             if (instance.instanceType, name) not in completed}
 
         if not benchmarks_to_run:
             logger.info("Skipping already benchmarked instance: {}".format(instance.instanceType))
             # leave this instance out if there is no benchmark to run
             continue
+        if instance.instanceType in last_run:
+            age = (now - last_run[instance.instanceType]).total_seconds()
+        else:
+            age = float('inf')
+        yield instance, benchmarks_to_run, age
+
+
+def ec2_scheduler():
+    return QuotaScheduler({pool: int(quota*quota_share) for pool, quota in get_vcpu_quotas().items()},
+                          max_running=max_running_instances)
+
+
+def get_ec2_performance(prices_df, perf_df=None, update=None, expire=None, tags=[], journal=None, **filter_opts):
+    scheduler = ec2_scheduler()
+    for instance, benchmarks_to_run, age in ec2_benchmark_queue(prices_df, perf_df, update, expire, journal):
         ami = aws_get_latest_ami(arch=instance.cpu_arch)
-        bench_args.append([ami, instance, tags, benchmarks_to_run])
-    if bench_args:
-        pool = ThreadPool(4)
-        results = [res for res in pool.map(run_benchmarks, bench_args) if res is not None]
-        if results:
-            return pd.concat(results, ignore_index=True, sort=False)
+        # start with the least recently benchmarked and the longest running
+        # instances
+        priority = (-age, -estimate_runtime(instance, benchmarks_to_run))
+        scheduler.submit([ami, instance, tags, benchmarks_to_run, journal], pool=vcpu_quota_pool(instance.instanceType),
+                         cost=instance.vcpu, priority=priority, name=instance.instanceType)
+    results = [res for res in scheduler.run(run_benchmarks) if res is not None]
+    if journal:
+        # this has the results of the earlier runs as well
+        return journal.frame()
+    if results:
+        return pd.concat(results, ignore_index=True, sort=False)
     return pd.DataFrame({})
+
+
+def plan_ec2_performance(prices_df, perf_df=None, update=None, expire=None, journal=None, trace=(), region=None):
+    """Plan a get_ec2_performance run without launching anything: the
+    instances it would benchmark, their estimated runtimes (refined by the
+    trace's spans of earlier runs), prices and costs, and their start and end
+    times (seconds) as the scheduler would run them.
+
+    An instance is expected to run as spot if the region has a spot price for
+    it which is lower than the on-demand price (the maximum spot price), and
+    the price of the run is the lowest spot or the on-demand price.
+    """
+    region = region or aws_get_region()
+    local_prices = prices_df[prices_df['region'] == region]
+    spot_prices = local_prices[local_prices['spot'] == True].groupby('instanceType', observed=True)['price'].min()
+    on_demand_prices = local_prices[local_prices['spot'] != True].groupby('instanceType', observed=True)['price'].min()
+    model = RuntimeModel(trace, vcpus=dict(zip(prices_df['instanceType'], prices_df['vcpu'])))
+
+    scheduler = ec2_scheduler()
+    rows = []
+    for instance, benchmarks_to_run, age in ec2_benchmark_queue(prices_df, perf_df, update, expire, journal):
+        runtime = estimate_runtime(instance, benchmarks_to_run, model)
+        on_demand = on_demand_prices.get(instance.instanceType, instance.price)
+        spot_price = spot_prices.get(instance.instanceType)
+        spot = spot_price is not None and spot_price < on_demand
+        price = spot_price if spot else on_demand
+        rows.append({'instanceType': instance.instanceType, 'cpu_arch': instance.cpu_arch, 'vcpu': instance.vcpu,
+                     'benchmarks': len(benchmarks_to_run), 'runtime': runtime, 'spot': spot, 'price': price,
+                     'cost': price*runtime/3600})
+        scheduler.submit(len(rows)-1, pool=vcpu_quota_pool(instance.instanceType, spot=spot), cost=instance.vcpu,
+                         priority=(-age, -estimate_runtime(instance, benchmarks_to_run)), name=instance.instanceType)
+    plan = pd.DataFrame(rows, columns=['instanceType', 'cpu_arch', 'vcpu', 'benchmarks', 'runtime', 'spot', 'price',
+                                       'cost'])
+    for i, start, end in scheduler.simulate(lambda i: rows[i]['runtime']):
+        plan.loc[i, 'start'] = start
+        plan.loc[i, 'end'] = end
+    return plan.sort_values('start') if len(plan) else plan.assign(start=[], end=[])
@@ -0,0 +1,103 @@
+from __future__ import absolute_import
+import numpy as np
+from cloudperf.filters import Filter
+
+# the columns to optimize on by default and their direction
+default_objectives = (('benchmark_score', 'max'), ('price', 'min'), ('memory', 'max'), ('vcpu', 'max'))
+# compare this many rows at once in pareto_mask
+pareto_chunk_size = 512
+
+
+def parse_objectives(specs):
+    """Parse column:max or column:min (the default) specs"""
+    objectives = []
+    for spec in specs:
+        col, _, direction = spec.partition(':')
+        direction = direction or 'min'
+        if direction not in ('min', 'max'):
+            raise ValueError("Objective direction must be min or max: {}".format(spec))
+        objectives.append((col, direction))
+    return tuple(objectives)
+
+
+def dominance(a, b):
+    """Return a len(a)*len(b) boolean matrix, True where a's row dominates b's
+    row (all values are to be minimized)"""
+    le = np.ones((len(a), len(b)), dtype=bool)
+    lt = np.zeros((len(a), len(b)), dtype=bool)
+    # column by column, to avoid the len(a)*len(b)*k temporaries
+    for i in range(a.shape[1]):
+        le &= a[:, None, i] <= b[None, :, i]
+        lt |= a[:, None, i] < b[None, :, i]
+    return le & lt
+
+
+def dominated_by(a, b):
+    """Return a len(b) long boolean array, True where b's row is dominated by
+    any of a's rows"""
+    if not len(a) or not len(b):
+        return np.zeros(len(b), dtype=bool)
+    return dominance(a, b).any(axis=0)
+
+
+def pareto_mask(values, chunk_size=pareto_chunk_size):
+    """Return a boolean mask of the non-dominated rows of values (an n*k
+    array, all columns to be minimized).
+
+    The rows are sorted by the sum of their per column ranks, so a row can only
+    be dominated by the ones before it, and the rows likely to dominate many
+    others come first. Each chunk is compared with the frontier found so far
+    and its remaining rows with each other, so the work is proportional to
+    the frontier's size instead of to n**2."""
+    n = len(values)
+    ranks = np.column_stack([np.unique(col, return_inverse=True)[1].reshape(-1) for col in values.T])
+    order = np.argsort(ranks.sum(axis=1), kind='stable')
+    values = values[order]
+    keep = np.zeros(n, dtype=bool)
+    frontier = values[:0]
+    for start in range(0, n, chunk_size):
+        chunk = values[start:start+chunk_size]
+        candidates = np.flatnonzero(~dominated_by(frontier, chunk))
+        rows = chunk[candidates]
+        # within the chunk only the earlier rows can dominate the later ones
+        candidates = candidates[~np.triu(dominance(rows, rows), k=1).any(axis=0)]
+        keep[start+candidates] = True
+        frontier = np.concatenate([frontier, chunk[candidates]])
+    mask = np.zeros(n, dtype=bool)
+    mask[order] = keep
+    return mask
+
+
+def pareto_frontier(df, objectives=default_objectives, by='benchmark_id'):
+    """Return the rows of df which are not dominated in the objectives (a
+    sequence of (column, 'min' or 'max') tuples) by any other row of the same
+    by group. Rows with missing values are left out."""
+    cols = [col for col, _ in objectives]
+    df = df.dropna(subset=cols)
+    # minimize everything
+    values = np.column_stack([df[col].to_numpy(dtype=float) * (-1 if direction == 'max' else 1)
+                              for col, direction in objectives])
+    mask = np.zeros(len(df), dtype=bool)
+    if by is None:
+        mask = pareto_mask(values)
+    else:
+        for idx in df.groupby(by, observed=True, sort=False).indices.values():
+            mask[idx] = pareto_mask(values[idx])
+    return df[mask]
+
+
+def top_k(df, k=10, sort='price', ascending=True, filters=(), frontier=False, objectives=default_objectives,
+          by='benchmark_id'):
+    """Return the best k rows by sort among the ones matching filters, eg. the
+    cheapest instances (and their region/AZ) having at least a given score and
+    memory.
+
+    With frontier, only the Pareto optimal rows are considered. If the filters
+    are lower bounds on maximized (or upper bounds on minimized) objectives
+    and sort is one of them, the best row is always among these."""
+    df = Filter(filters)(df)
+    if frontier:
+        df = pareto_frontier(df, objectives, by)
+    if df[sort].dtype.kind in 'iuf':
+        return df.nsmallest(k, sort) if ascending else df.nlargest(k, sort)
+    return df.sort_values(sort, ascending=ascending).head(k)
@@ -0,0 +1,102 @@
+# Sampling strategies for the benchmark runs.
+# This module is also executed on the benchmarked instances, so it must only
+# use the standard library and stay compatible with the python there.
+from __future__ import absolute_import, division
+
+
+def geometric_points(maxcpu):
+    """1, 2, 4, ... and maxcpu"""
+    points = set([maxcpu])
+    n = 1
+    while n < maxcpu:
+        points.add(n)
+        n *= 2
+    return sorted(points)
+
+
+def interpolate(x, x0, y0, x1, y1):
+    if y0 is None or y1 is None:
+        return None
+    return y0 + (y1-y0)*(x-x0)/(x1-x0)
+
+
+def adaptive_cpu_sweep(maxcpu, measure, tolerance=0.05):
+    """Capture the score curve of 1..maxcpu CPUs without measuring all points.
+
+    measure(n) is called for the geometric points first, then the intervals
+    between the measured points are bisected as long as the measured midpoint
+    differs from the linear interpolation of the interval's ends by more than
+    tolerance (relative). The points not measured are linearly interpolated.
+
+    Returns:
+        list of (numcpu, score, interpolated) tuples for each number of CPUs
+    """
+    scores = {}
+
+    def run(n):
+        if n not in scores:
+            scores[n] = measure(n)
+        return scores[n]
+
+    points = geometric_points(maxcpu)
+    for n in points:
+        run(n)
+    intervals = list(zip(points, points[1:]))
+    while intervals:
+        a, b = intervals.pop()
+        if b-a < 2:
+            continue
+        m = (a+b)//2
+        predicted = interpolate(m, a, scores[a], b, scores[b])
+        actual = run(m)
+        if predicted is None or actual is None or abs(actual-predicted) > tolerance*abs(actual):
+            intervals.extend([(a, m), (m, b)])
+
+    res = []
+    measured = sorted(scores)
+    for a, b in zip(measured, measured[1:]):
+        res.append((a, scores[a], False))
+        for n in range(a+1, b):
+            res.append((n, interpolate(n, a, scores[a], b, scores[b]), True))
+    res.append((measured[-1], scores[measured[-1]], False))
+    return res
+
+
+def sample_stats(samples):
+    """Return the number, mean, standard deviation, minimum and maximum of the
+    valid (not None) samples"""
+    valid = [s for s in samples if s is not None]
+    n = len(valid)
+    if not n:
+        return {'n': 0, 'mean': None, 'stddev': None, 'min': None, 'max': None}
+    mean = sum(valid)/n
+    stddev = (sum((s-mean)**2 for s in valid)/(n-1))**0.5 if n > 1 else 0.0
+    return {'n': n, 'mean': mean, 'stddev': stddev, 'min': min(valid), 'max': max(valid)}
+
+
+def coefficient_of_variation(samples):
+    stats = sample_stats(samples)
+    if stats['n'] < 2 or not stats['mean']:
+        return None
+    return stats['stddev']/abs(stats['mean'])
+
+
+def run_until_stable(run_once, min_iterations=2, max_iterations=10, cv_threshold=None):
+    """Call run_once() min_iterations times and, if cv_threshold is given,
+    continue until the coefficient of variation of the valid samples drops
+    below it or max_iterations is reached.
+
+    Returns:
+        list of the samples (None for the failed runs)
+    """
+    samples = []
+    while len(samples) < max(min_iterations, 1):
+        samples.append(run_once())
+    if cv_threshold is None:
+        return samples
+    while len(samples) < max_iterations:
+        cv = coefficient_of_variation(samples)
+        if cv is not None and cv < cv_threshold:
+            break
+        samples.append(run_once())
+    return samples
@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+import numpy as np
+import pandas as pd
+from cloudperf.core import performance_cols, performance_keys
+
+# the model columns of the summary, next to the performance_cols of the
+# maximum CPU row
+scaling_cols = ['benchmark_points', 'score_1', 'score_max', 'score_max_cpus', 'efficiency', 'efficiency_half',
+                'amdahl_serial', 'usl_sigma', 'usl_kappa', 'usl_peak_cpus']
+
+
+def fit(codes, ngroups, basis, y):
+    """Least squares fit of y to the basis columns (an n*k array) in each
+    group given by codes, vectorized by solving all the groups' normal
+    equations at once. Groups with less than k points get NaNs."""
+    k = basis.shape[1]
+    ata = np.empty((ngroups, k, k))
+    aty = np.empty((ngroups, k))
+    for i in range(k):
+        aty[:, i] = np.bincount(codes, basis[:, i] * y, ngroups)
+        for j in range(i, k):
+            ata[:, i, j] = ata[:, j, i] = np.bincount(codes, basis[:, i] * basis[:, j], ngroups)
+    coef = np.einsum('gij,gj->gi', np.linalg.pinv(ata), aty)
+    coef[np.bincount(codes, minlength=ngroups) < k] = np.nan
+    return coef
+
+
+def scaling_summary(perf_df):
+    """Summarize the benchmark_cpus sweeps into one row per instance type and
+    benchmark: the maximum CPU result (the same as performance(maxcpu=True)
+    gives) and the scaling model columns:
+
+    - score_1: the fitted single CPU score
+    - score_max, score_max_cpus: the best score and the CPUs giving it
+    - efficiency: the parallel efficiency at the maximum CPUs,
+      benchmark_score / (benchmark_cpus * score_1)
+    - efficiency_half: the same at up to half of the CPUs. If it's much
+      higher than efficiency, the second half of the CPUs are SMT siblings,
+      if it's already well below 1, the single CPU score is turbo boosted
+    - amdahl_serial: the serial fraction of Amdahl's law
+    - usl_sigma, usl_kappa: the contention and coherency parameters of the
+      Universal Scalability Law, X(N) = score_1 * N / (1 + s*(N-1) + k*N*(N-1))
+    - usl_peak_cpus: the number of CPUs where the USL curve peaks
+
+    The models are fitted in their linearized form, N/X(N) being a
+    polynomial of N, on the points with a positive score."""
+    if perf_df.empty:
+        return pd.DataFrame(columns=performance_cols + scaling_cols)
+    df = perf_df.sort_values('benchmark_cpus')
+    res = df.drop_duplicates(performance_keys, keep='last').set_index(performance_keys)
+    res = res[[c for c in performance_cols if c in res]]
+    df = df[df['benchmark_score'] > 0]
+    # the group of each point is its row in res
+    codes = res.index.get_indexer(pd.MultiIndex.from_frame(df[performance_keys]))
+    ngroups = len(res)
+
+    n = df['benchmark_cpus'].to_numpy(dtype=float)
+    x = df['benchmark_score'].to_numpy(dtype=float)
+    y = n / x
+    ones = np.ones_like(n)
+    amdahl = fit(codes, ngroups, np.column_stack([ones, n-1]), y)
+    usl = fit(codes, ngroups, np.column_stack([ones, n-1, n*(n-1)]), y)
+
+    res['benchmark_points'] = np.bincount(codes, minlength=ngroups)
+    best = df.sort_values('benchmark_score').drop_duplicates(performance_keys, keep='last') \
+        .set_index(performance_keys).reindex(res.index)
+    # with a single point the best guess is linear scaling
+    single = res['benchmark_points'].to_numpy() == 1
+    with np.errstate(divide='ignore'):
+        score_1 = np.where(single, best['benchmark_score'] / best['benchmark_cpus'], 1 / usl[:, 0])
+        score_1 = np.where(np.isnan(score_1), 1 / amdahl[:, 0], score_1)
+    res['score_1'] = score_1
+    res['score_max'] = best['benchmark_score']
+    res['score_max_cpus'] = best['benchmark_cpus']
+    res['efficiency'] = res['benchmark_score'] / (res['benchmark_cpus'] * res['score_1'])
+    half = df[n <= res['benchmark_cpus'].to_numpy()[codes] / 2]
+    half = half.drop_duplicates(performance_keys, keep='last').set_index(performance_keys).reindex(res.index)
+    res['efficiency_half'] = half['benchmark_score'] / (half['benchmark_cpus'] * res['score_1'])
+    res['amdahl_serial'] = amdahl[:, 1] / amdahl[:, 0]
+    res['usl_sigma'] = usl[:, 1] / usl[:, 0]
+    res['usl_kappa'] = usl[:, 2] / usl[:, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        peak = np.sqrt((1 - res['usl_sigma']) / res['usl_kappa'])
+    # ignore the rounding errors of perfectly linear curves
+    res['usl_peak_cpus'] = peak.where(res['usl_kappa'] > 1e-9)
+    return res.reset_index()
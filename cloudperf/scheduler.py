@@ -0,0 +1,231 @@
+from __future__ import absolute_import
+import time
+import heapq
+import random
+import logging
+import itertools
+import threading
+import collections
+from logging import NullHandler
+
+logger = logging.getLogger(__name__)
+logger.addHandler(NullHandler())
+
+
+class Job(object):
+    def __init__(self, item, pool, cost, priority, name):
+        self.item = item
+        self.pool = pool
+        self.cost = cost
+        self.priority = priority
+        self.name = name
+
+
+class Lease(object):
+    """A running job's reservation of cost units from a quota pool.
+
+    The job can move its reservation to another pool (eg. from spot to
+    on-demand), should wait() before each call which is subject to the global
+    backoff and report throttled() requests."""
+
+    def __init__(self, scheduler, job, cost):
+        self.scheduler = scheduler
+        self.job = job
+        self.pool = job.pool
+        self.cost = cost
+
+    def switch(self, pool):
+        if pool == self.pool:
+            return
+        logger.info("{} moves from {} to {}".format(self.job.name, self.pool, pool))
+        self.scheduler.release(self.pool, self.cost)
+        self.cost = self.scheduler.acquire(pool, self.job.cost)
+        self.pool = pool
+
+    def wait(self):
+        self.scheduler.wait_backoff()
+
+    def throttled(self):
+        self.scheduler.throttle()
+
+    def succeeded(self):
+        self.scheduler.unthrottle()
+
+    def release(self):
+        if self.pool is not None:
+            self.scheduler.release(self.pool, self.cost)
+            self.pool = None
+
+
+class QuotaScheduler(object):
+    """Run jobs in threads, keeping as many of them running as the quotas
+    allow.
+
+    Each job needs cost units (eg. vCPUs) from a pool (eg. spot standard
+    instances), which has a quota. Pools without a quota are only limited by
+    max_running. Jobs are started in priority order (lower first), but a
+    job which doesn't fit into its pool's free capacity doesn't hold back the
+    ones which do.
+    Throttled requests set a global, exponentially increasing (jittered)
+    backoff period, during which no new jobs are started and the running ones
+    wait before making their throttled calls.
+    """
+
+    def __init__(self, quotas=None, max_running=32, backoff_base=1, backoff_cap=120, state_log_interval=300):
+        self.quotas = dict(quotas or {})
+        self.max_running = max_running
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.state_log_interval = state_log_interval
+        self.in_use = collections.defaultdict(int)
+        self.queue = []
+        self.running = {}
+        self.finished = 0
+        self.throttle_level = 0
+        self.backoff_until = 0
+        self.cond = threading.Condition()
+        self._seq = itertools.count()
+
+    def submit(self, item, pool=None, cost=0, priority=0, name=None):
+        job = Job(item, pool, cost, priority, name or str(item))
+        with self.cond:
+            heapq.heappush(self.queue, (priority, next(self._seq), job))
+            self.cond.notify_all()
+
+    def _fits(self, pool, cost, in_use=None):
+        in_use = self.in_use if in_use is None else in_use
+        quota = self.quotas.get(pool)
+        if quota is None:
+            return True
+        # a job larger than the whole quota may run alone
+        return in_use[pool] + min(cost, quota) <= quota
+
+    def _reserve(self, pool, cost, in_use=None):
+        in_use = self.in_use if in_use is None else in_use
+        quota = self.quotas.get(pool)
+        if quota is not None:
+            cost = min(cost, quota)
+        in_use[pool] += cost
+        return cost
+
+    def acquire(self, pool, cost):
+        """Reserve cost units from pool, blocking until they're available"""
+        with self.cond:
+            while not self._fits(pool, cost):
+                self.cond.wait()
+            return self._reserve(pool, cost)
+
+    def release(self, pool, cost):
+        with self.cond:
+            self.in_use[pool] -= cost
+            self.cond.notify_all()
+
+    def throttle(self):
+        with self.cond:
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff_base*2**self.throttle_level))
+            self.throttle_level = min(self.throttle_level+1, 16)
+            self.backoff_until = max(self.backoff_until, time.time()+delay)
+            logger.info("Throttled, backing off for {:.1f}s".format(self.backoff_until-time.time()))
+
+    def unthrottle(self):
+        with self.cond:
+            self.throttle_level = max(self.throttle_level-1, 0)
+
+    def wait_backoff(self):
+        with self.cond:
+            while time.time() < self.backoff_until:
+                self.cond.wait(self.backoff_until-time.time())
+
+    def _next_job(self):
+        # the first job in priority order which fits into its pool
+        for entry in sorted(self.queue):
+            job = entry[2]
+            if self._fits(job.pool, job.cost):
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                return job
+        return None
+
+    def state(self):
+        """Return the scheduler's queue and capacity state"""
+        with self.cond:
+            return {'queued': [entry[2].name for entry in sorted(self.queue)],
+                    'running': sorted(self.running.values()),
+                    'finished': self.finished,
+                    'in_use': dict(self.in_use),
+                    'quotas': dict(self.quotas),
+                    'backoff': max(0, self.backoff_until-time.time())}
+
+    def log_state(self):
+        state = self.state()
+        logger.info("Scheduler: {} queued, {} running, {} finished, in use: {}, quotas: {}, backoff: {:.0f}s".format(
+            len(state['queued']), len(state['running']), state['finished'],
+            state['in_use'], state['quotas'], state['backoff']))
+
+    def _run_job(self, func, job, lease, results):
+        try:
+            results.append(func(job.item, lease))
+        except Exception:
+            logger.exception("Error while running {}".format(job.name))
+        finally:
+            lease.release()
+            with self.cond:
+                self.running.pop(threading.current_thread().ident, None)
+                self.finished += 1
+                self.cond.notify_all()
+
+    def simulate(self, duration):
+        """Predict when the submitted jobs would start and finish (in seconds
+        from now) if each ran for duration(item) seconds, without running or
+        dequeuing them. Throttling backoffs are not simulated.
+
+        Returns:
+            list of (item, start, end) tuples in start order
+        """
+        with self.cond:
+            queue = sorted(self.queue)
+        in_use = collections.defaultdict(int)
+        # (end, seq, job, reserved cost) of the running jobs
+        running = []
+        now = 0.0
+        res = []
+        while queue or running:
+            while len(running) < self.max_running:
+                entry = next((e for e in queue if self._fits(e[2].pool, e[2].cost, in_use)), None)
+                if entry is None:
+                    break
+                queue.remove(entry)
+                job = entry[2]
+                cost = self._reserve(job.pool, job.cost, in_use)
+                end = now + duration(job.item)
+                heapq.heappush(running, (end, entry[1], job, cost))
+                res.append((job.item, now, end))
+            if not running:
+                # can't happen with the quotas capped in _fits, but don't loop
+                break
+            now, _, job, cost = heapq.heappop(running)
+            in_use[job.pool] -= cost
+        return res
+
+    def run(self, func):
+        """Run func(item, lease) for all submitted jobs and return their
+        results in completion order"""
+        results = []
+        last_log = time.time()
+        with self.cond:
+            while self.queue or self.running:
+                if time.time()-last_log >= self.state_log_interval:
+                    self.log_state()
+                    last_log = time.time()
+                job = None
+                if len(self.running) < self.max_running and time.time() >= self.backoff_until:
+                    job = self._next_job()
+                if job is None:
+                    self.cond.wait(min(self.state_log_interval, max(1, self.backoff_until-time.time())))
+                    continue
+                lease = Lease(self, job, self._reserve(job.pool, job.cost))
+                t = threading.Thread(target=self._run_job, args=(func, job, lease, results), name=job.name)
+                t.daemon = True
+                t.start()
+                self.running[t.ident] = job.name
+        return results
@@ -0,0 +1,169 @@
+from __future__ import absolute_import
+import os
+import re
+import json
+import time
+import logging
+import threading
+import urllib.parse
+from logging import NullHandler
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cloudperf import cache
+from cloudperf.core import Dataset, is_url
+from cloudperf.filters import Filter
+
+logger = logging.getLogger(__name__)
+logger.addHandler(NullHandler())
+
+# check the sources for changes this often (seconds)
+refresh_interval = 300
+
+
+def source_version(src):
+    """Return something which changes when the src file/URL does"""
+    if isinstance(src, str) and is_url(src) and src.startswith('http'):
+        if cache.enabled():
+            # revalidates the cached copy with a conditional GET
+            cache.fetch(src)
+            return cache.etag(src)
+        import requests
+        r = requests.head(src, timeout=cache.fetch_timeout)
+        return r.headers.get('ETag') or r.headers.get('Last-Modified')
+    if isinstance(src, str) and os.path.exists(src):
+        return os.path.getmtime(src)
+    return None
+
+
+class Frames(object):
+    """The prices and performance data kept in memory, reloaded in the
+    background when the sources change"""
+
+    def __init__(self, prices, perf, refresh_interval=refresh_interval):
+        self.sources = {'prices': prices, 'perf': perf}
+        self.refresh_interval = refresh_interval
+        self.versions = self.source_versions()
+        self.dataset = self.load()
+        self.loaded = time.time()
+
+    def source_versions(self):
+        return {name: source_version(src) for name, src in self.sources.items()}
+
+    def load(self):
+        ds = Dataset(**self.sources)
+        # compute the most used views before they're served
+        ds.prices()
+        ds.combined(maxcpu=True)
+        return ds
+
+    def refresh(self):
+        try:
+            versions = self.source_versions()
+            if versions == self.versions:
+                return False
+            logger.info("Sources have changed, reloading")
+            # queries are served from the old data until the new is ready
+            self.dataset = self.load()
+            self.versions = versions
+            self.loaded = time.time()
+            return True
+        except Exception:
+            logger.exception("Couldn't refresh the data")
+            return False
+
+    def refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            self.refresh()
+
+    def start(self):
+        t = threading.Thread(target=self.refresh_loop, name='refresh')
+        t.daemon = True
+        t.start()
+
+
+def query(ds, kind, params):
+    """Run a query given by the (parse_qs style) params on ds"""
+    def param(name, default=None):
+        return params.get(name, [default])[-1]
+
+    def flag(name, default):
+        return param(name, str(default)).lower() in ('1', 'true', 'yes')
+
+    filters = Filter(params.get('filter', []))
+    # the filters go through the Dataset's views, so they're pushed down and
+    # memoized the same way as in the CLI
+    if kind == 'prices':
+        df = ds.prices(filters=filters)
+        sort = ['price']
+    elif kind == 'performance':
+        maxcpu = flag('maxcpu', True)
+        if flag('combined', True):
+            spot_duration = param('spot_duration')
+            df = ds.combined(maxcpu=maxcpu, spot_duration=float(spot_duration) if spot_duration else None,
+                             filters=filters)
+            sort = ['perf/price']
+        else:
+            df = ds.performance(maxcpu=maxcpu, filters=filters)
+            sort = ['benchmark_score']
+    else:
+        raise ValueError("Unknown query: {}".format(kind))
+
+    sort = [c for s in params.get('sort', sort) for c in s.split(',')]
+    ascending = not flag('desc', False)
+    limit = param('limit')
+    if limit is not None and len(sort) == 1 and df[sort[0]].dtype.kind in 'iuf':
+        # top-n without sorting everything
+        df = df.nsmallest(int(limit), sort[0]) if ascending else df.nlargest(int(limit), sort[0])
+    else:
+        df = df.sort_values(sort, ascending=ascending)
+        if limit is not None:
+            df = df.head(int(limit))
+    if 'cols' in params:
+        df = df[[c for cols in params['cols'] for c in cols.split(',')]]
+    return df
+
+
+class Handler(BaseHTTPRequestHandler):
+    """GET /prices, /performance and /status. The query parameters are:
+    filter (repeated, like --filter), sort, cols (comma separated), desc,
+    limit and for /performance combined, maxcpu and spot_duration."""
+
+    def send(self, code, body):
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        kind = url.path.strip('/')
+        frames = self.server.frames
+        if kind == 'status':
+            self.send(200, json.dumps({'loaded': frames.loaded, 'versions': frames.versions}, default=str))
+            return
+        if kind not in ('prices', 'performance'):
+            self.send(404, json.dumps({'error': 'Unknown path {}'.format(url.path)}))
+            return
+        try:
+            df = query(frames.dataset, kind, urllib.parse.parse_qs(url.query))
+        # invalid regexes in the filters raise re.error, numexpr raises
+        # NotImplementedError for the column types its version can't handle
+        except (KeyError, ValueError, TypeError, NotImplementedError, re.error) as e:
+            self.send(400, json.dumps({'error': 'Bad query: {!r}'.format(e)}))
+            return
+        self.send(200, df.to_json(orient='records', date_unit='s'))
+
+    def log_message(self, format, *args):
+        logger.info("{} {}".format(self.address_string(), format % args))
+
+
+def serve(prices, perf, host='127.0.0.1', port=8080, refresh_interval=refresh_interval):
+    frames = Frames(prices, perf, refresh_interval)
+    frames.start()
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    httpd.frames = frames
+    logger.info("Serving on {}:{}".format(host, port))
+    httpd.serve_forever()
@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+import numpy as np
+import pandas as pd
+from cloudperf.core import join_cols
+from cloudperf.filters import Filter
+
+offer_cols = ['instanceType', 'region', 'spot', 'spot-az', 'price', 'vcpu', 'node_cpus', 'node_score']
+# consider this many of the best homogeneous fleets' offers (and the same
+# number of the best perf/price ones) for the mixed fleets
+mixed_candidates = 40
+# fleets are ordered by these, so the ones of the same price come in a stable
+# order, the homogeneous ones first
+fleet_sort_cols = ['price', 'instance_types', 'instanceType_1', 'instanceType_2', 'region_1', 'region_2',
+                   'spot-az_1', 'spot-az_2']
+
+
+def node_scores(perf_df, benchmark_id, max_cpus=None):
+    """Return the score of one node of each instance type (and the number of
+    CPUs giving it), using at most max_cpus CPUs per node.
+
+    The score is read from the measured benchmark_cpus curve: the best score
+    with at most max_cpus CPUs, or if it's between two measured points, their
+    linear interpolation, whichever is higher."""
+    df = perf_df[(perf_df['benchmark_id'] == benchmark_id) & (perf_df['benchmark_score'] > 0)]
+    df = df[join_cols + ['benchmark_cpus', 'benchmark_score']].sort_values('benchmark_cpus')
+    if max_cpus is None:
+        below = df
+    else:
+        below = df[df['benchmark_cpus'] <= max_cpus]
+    # the best point with the allowed number of CPUs. More CPUs are allowed to
+    # give lower scores (eg. due to SMT), we can always run less
+    best = below.sort_values('benchmark_score').drop_duplicates(join_cols, keep='last').set_index(join_cols)
+    res = best.rename(columns={'benchmark_cpus': 'node_cpus', 'benchmark_score': 'node_score'})
+    if max_cpus is None:
+        return res
+
+    lo = below.drop_duplicates(join_cols, keep='last').set_index(join_cols)
+    hi = df[df['benchmark_cpus'] > max_cpus].drop_duplicates(join_cols, keep='first').set_index(join_cols)
+    # types measured only above max_cpus are interpolated from (0, 0)
+    lo = lo.reindex(hi.index).fillna({'benchmark_cpus': 0, 'benchmark_score': 0})
+    interpolated = lo['benchmark_score'] + (hi['benchmark_score']-lo['benchmark_score']) * \
+        (max_cpus-lo['benchmark_cpus']) / (hi['benchmark_cpus']-lo['benchmark_cpus'])
+    res = res.reindex(res.index.union(hi.index))
+    interpolated = interpolated.reindex(res.index)
+    better = interpolated > res['node_score'].fillna(0)
+    res.loc[better, 'node_score'] = interpolated[better]
+    res.loc[better, 'node_cpus'] = max_cpus
+    return res
+
+
+def fleet_offers(prices_df, scores, filters=()):
+    """Join the prices with the node scores"""
+    offers = prices_df.merge(scores.reset_index(), on=join_cols)
+    offers = Filter(filters)(offers)
+    offers = offers[(offers['price'] > 0) & (offers['node_score'] > 0)]
+    return offers[[c for c in offer_cols if c in offers]].reset_index(drop=True)
+
+
+def fleet_frame(offers, i, n_i, j=None, n_j=None):
+    """Build the result frame from offer indices and node counts"""
+    a = offers.iloc[i].reset_index(drop=True)
+    res = pd.DataFrame({'nodes_1': n_i})
+    for c in offers.columns:
+        res[c + '_1'] = a[c]
+    if j is None:
+        res['nodes_2'] = 0
+        cost = n_i * a['price'].to_numpy()
+        score = n_i * a['node_score'].to_numpy()
+    else:
+        b = offers.iloc[j].reset_index(drop=True)
+        res['nodes_2'] = n_j
+        for c in offers.columns:
+            res[c + '_2'] = b[c]
+        cost = n_i * a['price'].to_numpy() + n_j * b['price'].to_numpy()
+        score = n_i * a['node_score'].to_numpy() + n_j * b['node_score'].to_numpy()
+    res['score'] = score
+    res['price'] = cost
+    return res
+
+
+def sort_fleets(fleets):
+    fleets = fleets.assign(instance_types=np.where(fleets['nodes_2'] > 0, 2, 1))
+    return fleets.sort_values([c for c in fleet_sort_cols if c in fleets], kind='stable') \
+        .drop(columns='instance_types')
+
+
+def homogeneous_fleets(offers, target):
+    """The cheapest fleet of each offer reaching target score"""
+    nodes = np.ceil(target / offers['node_score'].to_numpy()).astype(int)
+    return sort_fleets(fleet_frame(offers, np.arange(len(offers)), nodes))
+
+
+def mixed_fleets(offers, target, candidates=mixed_candidates):
+    """The cheapest two-offer fleets reaching target score.
+
+    The candidates are the offers with the cheapest homogeneous fleets and
+    the best perf/price. For each pair, all node counts of the first offer
+    are tried (with the second offer covering the rest), vectorized."""
+    s = offers['node_score'].to_numpy(dtype=float)
+    p = offers['price'].to_numpy(dtype=float)
+    homogeneous_cost = np.ceil(target / s) * p
+    cand = np.union1d(np.argsort(homogeneous_cost, kind='stable')[:candidates],
+                      np.argsort(-s/p, kind='stable')[:candidates])
+    best = {}
+    for i in cand:
+        counts = np.arange(0, int(np.ceil(target / s[i])) + 1)
+        rest = np.maximum(target - counts * s[i], 0)
+        # counts x candidates matrix of the second offer's node counts
+        other = np.ceil(rest[:, None] / s[None, cand])
+        cost = counts[:, None] * p[i] + other * p[None, cand]
+        # the pair with itself is a homogeneous fleet
+        cost[:, cand == i] = np.inf
+        # mixes need both offers
+        cost[other == 0] = np.inf
+        cost[0, :] = np.inf
+        rows = cost.argmin(axis=0)
+        for k, (j, row) in enumerate(zip(cand, rows)):
+            if np.isfinite(cost[row, k]):
+                key = (min(i, j), max(i, j))
+                if key not in best or cost[row, k] < best[key][0]:
+                    best[key] = (cost[row, k], i, counts[row], j, int(other[row, k]))
+    if not best:
+        return fleet_frame(offers, [], [], [], [])
+    _, i, n_i, j, n_j = map(np.array, zip(*best.values()))
+    return sort_fleets(fleet_frame(offers, i, n_i, j, n_j))
+
+
+def size_fleet(prices_df, perf_df, benchmark_id, target, max_cpus=None, filters=(), mixed=True, top=10):
+    """Return the cheapest fleets (per hour) reaching target aggregate
+    benchmark_id score, homogeneous and if mixed is set, two-type ones"""
+    offers = fleet_offers(prices_df, node_scores(perf_df, benchmark_id, max_cpus), filters)
+    fleets = [homogeneous_fleets(offers, target).head(top)]
+    if mixed:
+        fleets.append(mixed_fleets(offers, target).head(top))
+    return sort_fleets(pd.concat(fleets, ignore_index=True, sort=False)).head(top)
@@ -0,0 +1,115 @@
+from __future__ import absolute_import
+import os
+import re
+import gzip
+import json
+import hashlib
+import logging
+from datetime import datetime
+from logging import NullHandler
+from cloudperf.core import web_cols
+
+logger = logging.getLogger(__name__)
+logger.addHandler(NullHandler())
+
+shard_cols = web_cols + ['cpu_arch', 'benchmark_score', 'price', 'region', 'spot', 'spot-az', 'perf/price']
+json_content_type = 'application/json; charset=utf-8'
+
+
+def gzip_compress(data):
+    # mtime=0 makes the output reproducible, unchanged shards give the same
+    # bytes
+    return gzip.compress(data, 9, mtime=0)
+
+
+def brotli_compress(data):
+    import brotli
+    return brotli.compress(data, quality=11)
+
+
+def zstd_compress(data):
+    import zstandard
+    return zstandard.ZstdCompressor(level=19).compress(data)
+
+
+# Content-Encoding -> (file suffix, compressor, required module)
+encodings = {
+    'gzip': ('.gz', gzip_compress, None),
+    'br': ('.br', brotli_compress, 'brotli'),
+    'zstd': ('.zst', zstd_compress, 'zstandard'),
+}
+
+
+def available_encodings():
+    res = []
+    for name, (suffix, compress, module) in encodings.items():
+        if module is not None:
+            try:
+                __import__(module)
+            except ImportError:
+                continue
+        res.append(name)
+    return res
+
+
+def slug(value):
+    return re.sub('[^A-Za-z0-9._-]+', '_', str(value))
+
+
+def best_offers(combined_df):
+    """Reduce the (maxcpu) combined data to the best perf/price offer (region,
+    AZ, spot or on-demand) of each instance type and benchmark, best first"""
+    df = combined_df.dropna(subset=['perf/price'])
+    df = df[[c for c in shard_cols if c in df]]
+    return df.sort_values('perf/price', ascending=False).drop_duplicates(['instanceType', 'benchmark_id'])
+
+
+def shards(combined_df):
+    """Yield (benchmark_id, cpu_arch, DataFrame) for each benchmark and for
+    each of its CPU architectures (cpu_arch is None for the former)"""
+    df = best_offers(combined_df)
+    for benchmark_id, bdf in df.groupby('benchmark_id', observed=True, sort=True):
+        yield benchmark_id, None, bdf
+        if 'cpu_arch' in bdf:
+            for cpu_arch, adf in bdf.groupby('cpu_arch', observed=True, sort=True):
+                yield benchmark_id, cpu_arch, adf
+
+
+def write_shards(combined_df, directory, prefix='webperf/'):
+    """Write the web shards, their compressed copies and a manifest into
+    directory.
+
+    Returns:
+        list of (path, key, content_type, content_encoding) tuples of the
+        written files, key is the name to upload the file to
+    """
+    os.makedirs(directory, exist_ok=True)
+    encs = available_encodings()
+    files = []
+    manifest = {'generated': datetime.now().isoformat(), 'encodings': encs, 'shards': []}
+
+    def write(name, data, content_encoding=None):
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        files.append((path, prefix + name, json_content_type, content_encoding))
+        return path
+
+    for benchmark_id, cpu_arch, df in shards(combined_df):
+        name = slug(benchmark_id) if cpu_arch is None else '{}-{}'.format(slug(benchmark_id), slug(cpu_arch))
+        name += '.json'
+        data = df.to_json(orient='records').encode('utf-8')
+        # the uncompressed copy is kept locally only
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+        entry = {'benchmark_id': benchmark_id, 'cpu_arch': cpu_arch, 'rows': len(df), 'size': len(data),
+                 'sha1': hashlib.sha1(data).hexdigest(), 'files': {}}
+        for enc in encs:
+            suffix, compress, _ = encodings[enc]
+            write(name + suffix, compress(data), enc)
+            entry['files'][enc] = prefix + name + suffix
+        manifest['shards'].append(entry)
+        logger.info("Wrote web shard {} ({} rows)".format(name, len(df)))
+
+    write('manifest.json', json.dumps(manifest, indent=1).encode('utf-8'))
+    return files
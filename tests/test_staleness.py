@@ -0,0 +1,74 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from cloudperf.providers import aws_helpers
+from cloudperf.providers.aws_helpers import get_benchmarks_to_run, staleness_index
+
+now = datetime(2024, 6, 1, 12, 0, 0)
+twelve_weeks = 12*7*24*3600
+Instance = namedtuple('Instance', ['instanceType'])
+
+
+def perf(*runs):
+    return pd.DataFrame([{'instanceType': instance_type, 'benchmark_id': benchmark_id, 'benchmark_cpus': 1,
+                          'benchmark_score': 1.0, 'date': date} for instance_type, benchmark_id, date in runs])
+
+
+def test_multi_day_ages_expire():
+    # 3 days and 1 hour old: timedelta.seconds would only give the hour
+    df = perf(('c5.large', 'a', now - timedelta(days=3, hours=1)))
+    staleness = staleness_index(df, 2*24*3600, now)
+    assert staleness.loc[('c5.large', 'a'), 'expired']
+
+
+def test_multi_day_ages_not_expired():
+    df = perf(('c5.large', 'a', now - timedelta(days=3, hours=1)))
+    staleness = staleness_index(df, 4*24*3600, now)
+    assert not staleness.loc[('c5.large', 'a'), 'expired']
+
+
+def test_twelve_week_boundary():
+    df = perf(('c5.large', 'at', now - timedelta(weeks=12)),
+              ('c5.large', 'before', now - timedelta(weeks=12) + timedelta(seconds=1)),
+              ('c5.large', 'after', now - timedelta(weeks=12, seconds=1)))
+    staleness = staleness_index(df, twelve_weeks, now).loc['c5.large', 'expired']
+    assert staleness['at']
+    assert not staleness['before']
+    assert staleness['after']
+
+
+def test_last_run_counts():
+    df = perf(('c5.large', 'a', now - timedelta(weeks=20)),
+              ('c5.large', 'a', now - timedelta(days=1)))
+    staleness = staleness_index(df, twelve_weeks, now)
+    assert staleness.loc[('c5.large', 'a'), 'date'] == now - timedelta(days=1)
+    assert not staleness.loc[('c5.large', 'a'), 'expired']
+
+
+def test_empty_perf():
+    for df in (None, perf()):
+        staleness = staleness_index(df, twelve_weeks, now)
+        assert staleness.empty
+        assert get_benchmarks_to_run(Instance('c5.large'), staleness) == aws_helpers.benchmarks
+
+
+def test_benchmarks_to_run(monkeypatch):
+    monkeypatch.setattr(aws_helpers, 'benchmarks', {'fresh': {}, 'stale': {}, 'new': {}})
+    df = perf(('c5.large', 'fresh', now - timedelta(days=30)),
+              ('c5.large', 'stale', now - timedelta(days=100)),
+              ('m5.large', 'new', now - timedelta(days=1)))
+    staleness = staleness_index(df, twelve_weeks, now)
+    assert set(get_benchmarks_to_run(Instance('c5.large'), staleness)) == {'stale', 'new'}
+    assert set(get_benchmarks_to_run(Instance('r5.large'), staleness)) == {'fresh', 'stale', 'new'}
+
+
+def test_invalid_expire():
+    from click.testing import CliRunner
+    from cloudperf.cli import main
+
+    # a typo mustn't expire (and re-run) everything
+    res = CliRunner().invoke(main, ['write-performance', '--expire', '12x', '--plan'])
+    assert res.exit_code == 2
+    assert '--expire' in res.output